@@ -1,27 +1,1448 @@
 from tree_sitter import Language, Parser, Node
 import tree_sitter_c
-import re, os
+import re, os, mmap, codecs
+import hashlib, sqlite3
+import sys, time, json, functools, contextlib
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from collections.abc import Mapping
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import chardet
 # 加载C语言的解析器库
 C_LANGUAGE = Language(tree_sitter_c.language())
-parser = Parser(C_LANGUAGE)
 
 # 跨文件相关
 import threading
-# 使用线程本地存储来管理递归深度
-depth_tracker = threading.local()
-depth_tracker.value = 0
+# Parser 保存了解析状态，不能在线程之间共享，每个线程第一次解析时创建自己的 Parser
+class ParserLocal(threading.local):
+    def __init__(self) -> None:
+        self.parser = Parser(C_LANGUAGE)
+
+parser_local = ParserLocal()
+
+def get_parser() -> Parser:
+    return parser_local.parser
+
+# 使用线程本地存储标记当前线程是否正在头文件中查找
+# 头文件的搜索顺序由 IncludeGraph 一次性算出（已经包含了间接包含的头文件），
+# 所以在头文件上执行的方法不需要再自己跨文件
+# threading.local 的子类在每个线程第一次访问时都会执行 __init__，所以任何线程中 value 都有初始值 0
+class DepthTracker(threading.local):
+    def __init__(self) -> None:
+        self.value = 0
+
+depth_tracker = DepthTracker()
+# 保护 project_file_indexes、include_graphs、project_symbol_indexes 这些注册表的创建
+registry_lock = threading.Lock()
+# 最多搜索几层间接包含的头文件
 MAX_DEPTH = 6
 
+# 查询注册表：所有 query 都不带具体的 identifier，第一次使用时编译，之后复用
+# 需要按名字查找时，在 captures 上比较文本，而不是每次把 identifier 拼进 #eq? 重新编译
+QUERIES = {
+    # 前者匹配 "platform_lib.h"
+    # 后者匹配 <onlp/platformi/thermali.h>
+    "headers": """
+        (
+            (preproc_include
+                (string_literal) @header)
+            )
+            (
+            (preproc_include
+                (system_lib_string) @header_lib)
+            )
+    """,
+    "preproc_defs": """
+        (preproc_def
+            name: (identifier) @macro_def
+        )
+        (preproc_function_def
+            name: (identifier) @macro_def
+        )
+    """,
+    "enumerators": """
+        (enum_specifier
+            (enumerator_list
+                (enumerator
+                    name: (identifier) @enum_name
+                )
+            )
+        )
+    """,
+    "function_definitions": """(function_definition)@function""",
+    "function_declarations": """
+        (declaration
+            declarator: (function_declarator) @function_declarator
+        )
+    """,
+    "function_ids": """
+        (function_definition
+            (function_declarator
+                (identifier) @function_id
+            )
+        )
+    """,
+    "function_signature": """
+        (function_definition
+            (storage_class_specifier)* @storage_class_specifier
+            type:(_) @ret
+            declarator:[(function_declarator) (pointer_declarator)] @function_declarator
+        )
+    """,
+    "call_identifiers": """
+        (call_expression
+            function: (identifier)@identifier
+        )
+    """,
+    "identifiers": """(identifier)@id""",
+    # OccurrenceIndex 一次取出全部 identifier 和 type_identifier
+    "occurrences": """
+        (identifier) @identifier
+        (type_identifier) @type_identifier
+    """,
+    "type_identifiers": """(type_identifier) @type_identifier""",
+    "field_identifiers": """(field_identifier) @field_name""",
+    "macro_ids": """
+        ((identifier) @macro_def
+        (#match? @macro_def "^[A-Z_]+$")
+        )
+    """,
+    "extern_vars": """
+        (declaration
+            (storage_class_specifier) @storage_class_specifier
+            (#eq? @storage_class_specifier "extern")
+            type:(_)
+            declarator: (identifier) @identifier
+        )
+    """,
+    "global_vars": """
+        (declaration
+            type:(_)
+            declarator: (identifier)@decl
+        )
+        (declaration
+            type:(_)
+            (init_declarator) @init
+        )
+    """,
+    "declarator_ids": """declarator: ((identifier) @id)""",
+    "var_declarators": """
+        (declaration
+            type:(_)
+            declarator: (_) @declarator
+        )
+        (parameter_declaration
+            type:(_)
+            declarator: (_) @declarator
+        )
+    """,
+    # capture 名中 '_' 分隔的段数 - 1 就是从 identifier 往上到声明节点的层数
+    "local_vars": """
+        ; 1. 仅声明
+        (declaration
+            declarator: (identifier) @decl_id
+        )
+        ; 指针类型
+        (declaration
+            (pointer_declarator
+                declarator: (identifier) @decl_pointer_id
+            )
+        )
+        ; 2. 初始化变量
+        (declaration
+            (init_declarator
+                declarator: (identifier) @decl_init_id
+            )
+        )
+        (declaration
+            (init_declarator
+                (pointer_declarator
+                    declarator: (identifier) @decl_init_pointer_id
+                )
+            )
+        )
+        ; 3. 参数内变量
+        (parameter_declaration
+            declarator: (identifier) @param_id
+        )
+        (parameter_declaration
+            (pointer_declarator
+                declarator: (identifier) @param_pointer_id
+            )
+        )
+        ; 5. 特殊类型，如 数组 等以多个部分(且不并列)组成的
+        (declaration
+            (array_declarator
+                declarator: (identifier) @decl_array_id
+            )
+        )
+        (declaration
+            (init_declarator
+                (array_declarator
+                    declarator: (identifier) @decl_init_array_id
+                )
+            )
+        )
+        (declaration
+            (pointer_declarator
+                (array_declarator
+                    declarator: (identifier) @decl_pointer_array_id
+                )
+            )
+        )
+        (declaration
+            (init_declarator
+                (pointer_declarator
+                    (array_declarator
+                        declarator: (identifier) @decl_init_pointer_array_id
+                    )
+                )
+            )
+        )
+    """,
+    "type_defs": """
+        ( _
+            name: (type_identifier) @type_identifier
+            body: (field_declaration_list)
+        )
+        (type_definition
+            type: ( _ )
+            declarator: (type_identifier)@type_identifier
+        )
+        (enum_specifier
+            body: (enumerator_list) @enumerator_list
+        )
+    """,
+}
+# 一次匹配得到本文件的全部定义，用于建立符号表
+QUERIES["symbols"] = "\n".join(QUERIES[name] for name in [
+    "preproc_defs",
+    "enumerators",
+    "function_definitions",
+    "function_declarations",
+    "type_defs",
+    "extern_vars",
+])
+compiled_queries = {}
+# 编译好的 Query 可以在线程之间共享，锁只保证每个 query 只编译一次
+query_lock = threading.Lock()
+
+def get_query(name:str):
+    query = compiled_queries.get(name)
+    if query is None:
+        if instrumentation is not None:
+            instrumentation.count("query_cache_misses")
+        with query_lock:
+            query = compiled_queries.get(name)
+            if query is None:
+                query = compiled_queries[name] = C_LANGUAGE.query(QUERIES[name])
+    elif instrumentation is not None:
+        instrumentation.count("query_cache_hits")
+    return query
+
+# 在 node 上执行注册表中的 query，返回 {capture_name: [node, ...]}
+def query_captures(name:str, node:Node) -> dict:
+    return get_query(name).captures(node)
+
+# 沿声明符链（pointer_declarator、parenthesized_declarator、function_declarator 等）找到声明的名字
+# char *get_name(int id) 中函数定义的 declarator 是 pointer_declarator，名字在 function_declarator 之下
+def get_declarator_identifier(declarator:Node):
+    while declarator is not None and declarator.type not in ('identifier', 'field_identifier'):
+        next_declarator = declarator.child_by_field_name('declarator')
+        if next_declarator is None and declarator.named_child_count:
+            next_declarator = declarator.named_child(0)
+        declarator = next_declarator
+    return declarator
+
+# 父节点为这些类型的 identifier 不是变量，get_vars_in_line 中跳过
+VAR_EXCLUDED_PARENT_TYPES = (
+    'call_expression',
+    'enumerator',
+    'preproc_def',
+    'preproc_function_def',
+)
+
+# 只保留文本等于 identifier 的 capture，代替 #eq? 谓词
+def filter_captures(captures:dict, identifier:str) -> dict:
+    res = {}
+    for capture_name, nodes in captures.items():
+        nodes = [node for node in nodes if node.text.decode() == identifier]
+        if nodes:
+            res[capture_name] = nodes
+    return res
+
+# 项目文件索引：每个项目只遍历一次目录，所有 Cmodule 实例共享
+# 以路径分量倒序建立后缀树，例如 onlp/platformi/thermali.h 依次沿
+# thermali.h -> platformi -> onlp 向下查找，查找代价只与路径分量数有关
+class ProjectFileIndex():
+    def __init__(self, project_dir:str) -> None:
+        self.project_dir = os.path.abspath(project_dir)
+        self.refresh()
+
+    # 重新遍历项目目录，项目中文件增删后需要显式调用
+    # 先建好新的后缀树再整体替换，其他线程中的 find 不会看到建了一半的后缀树
+    def refresh(self):
+        suffix_tree = {}
+        # 项目中全部 .c 和 .h 文件
+        source_files = []
+        for root, _, files in os.walk(self.project_dir):
+            parts = root[len(self.project_dir):].split(os.sep)
+            parts = [part for part in parts if part]
+            for file in files:
+                path = os.path.join(root, file)
+                self.add(path, parts + [file], suffix_tree)
+                if file.endswith('.c') or file.endswith('.h'):
+                    source_files.append(path)
+        self.suffix_tree = suffix_tree
+        self.source_files = source_files
+        # 查找结果缓存，找不到的（通常是系统库，如 <stdio.h>）也会缓存为 ""
+        self.cache = {}
+
+    def add(self, path:str, parts:list[str], suffix_tree:dict = None):
+        node = self.suffix_tree if suffix_tree is None else suffix_tree
+        for part in reversed(parts):
+            node = node.setdefault(part, {})
+            # 同一后缀对应多个文件时，保留遍历时最先遇到的那个，与 os.walk 的行为一致
+            node.setdefault(None, path)
+
+    def split_partial_path(self, partial_path:str) -> list[str]:
+        return [part for part in partial_path.replace('\\', '/').split('/') if part and part != '.']
+
+    def find(self, partial_path:str) -> str:
+        if partial_path in self.cache:
+            if instrumentation is not None:
+                instrumentation.count("file_index_hits")
+            return self.cache[partial_path]
+        if instrumentation is not None:
+            instrumentation.count("file_index_misses")
+        node = self.suffix_tree
+        for part in reversed(self.split_partial_path(partial_path)):
+            node = node.get(part)
+            if node is None:
+                break
+        result = node.get(None, "") if node is not None else ""
+        self.cache[partial_path] = result
+        return result
+
+# project_dir -> ProjectFileIndex
+project_file_indexes = {}
+
+def get_project_file_index(project_dir:str) -> ProjectFileIndex:
+    key = os.path.abspath(project_dir)
+    index = project_file_indexes.get(key)
+    if index is None:
+        with registry_lock:
+            index = project_file_indexes.get(key)
+            if index is None:
+                index = project_file_indexes[key] = ProjectFileIndex(key)
+    return index
+
+# 根据头文件的写法得到完整路径，file_path 为包含该头文件的文件
+# "platform_lib.h" 先在 file_path 所在目录找，找不到再和 <onlp/platformi/thermali.h> 一样在项目中按后缀找
+def resolve_header_path(header:str, file_path:str, project_dir:str) -> str:
+    header_clean = header.strip('"<>')
+    if header.endswith('"') and file_path:
+        parent_dir = os.path.dirname(file_path)
+        abs_path = os.path.join(parent_dir, header_clean)
+        if os.path.exists(abs_path):
+            return abs_path
+    if not project_dir:
+        return ""
+    return get_project_file_index(project_dir).find(header_clean)
+
+# 一次扫描同时匹配注释和字符串/字符字面量，字面量中的 // 和 /* 不会被当成注释
+# 字面量只能用行尾的 \ 续行；没有闭合的引号（如 #error don't）只匹配引号本身，之后的注释照常清除
+# // 注释可以用行尾的 \ 续行，没有闭合的 /* 注释到文件末尾为止
+COMMENT_OR_LITERAL_RE = re.compile(rb"""
+    "(?:\\(?:\r?\n|.)|[^"\\\n])*"
+    | '(?:\\(?:\r?\n|.)|[^'\\\n])*'
+    | ["']
+    | //(?:\\\r?\n|[^\n])*
+    | /\*[\s\S]*?(?:\*/|\Z)
+""", re.VERBOSE)
+
+# 清除注释后代码中的 #include "..." 和 #include <...>，上一行以 \ 结尾时是宏定义的一部分，不算
+INCLUDE_RE = re.compile(rb'(?<!\\\n)^[ \t]*#[ \t]*include[ \t]*("(?:\\.|[^"\\\n])*"|<[^>\n]*>)', re.MULTILINE)
+
+# 单独的 \r（不是 \r\n 的一部分），splitlines 会把它当作换行
+LONE_CR_RE = re.compile(rb"\r(?!\n)")
+
+# 读取源文件：先按 UTF-8 校验，失败时只对开头的一部分用 chardet 判断编码
+# 超过 MMAP_THRESHOLD 的 UTF-8 文件用 mmap 读取，直接在映射的内存上清除注释，不再复制一份原始内容
+MMAP_THRESHOLD = 1024 * 1024
+CHARDET_SAMPLE_SIZE = 64 * 1024
+UTF8_CHECK_CHUNK_SIZE = 1024 * 1024
+
+def is_utf8(data) -> bool:
+    if isinstance(data, bytes) and data.isascii():
+        return True
+    # 分块校验，不会一次生成整个文件的 str
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    view = memoryview(data)
+    try:
+        for i in range(0, len(view), UTF8_CHECK_CHUNK_SIZE):
+            decoder.decode(view[i:i + UTF8_CHECK_CHUNK_SIZE])
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+# 返回 (UTF-8 编码的内容, 原文件编码)
+# use_mmap 为 True 且文件较大时，内容为 mmap 上的 memoryview，用完后需要 release_source
+# 不是 UTF-8 时才调用 chardet
+def detect_encoding(sample:bytes) -> str:
+    return chardet.detect(sample)['encoding'] or 'latin-1'
+
+def read_source(path:str, use_mmap:bool = False):
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        if use_mmap and size >= MMAP_THRESHOLD:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if is_utf8(mm):
+                view = memoryview(mm)
+                if mm[:3] == codecs.BOM_UTF8:
+                    view = view[3:]
+                return view, 'utf-8'
+            data = mm[:]
+            mm.close()
+        else:
+            data = f.read()
+    if is_utf8(data):
+        if data.startswith(codecs.BOM_UTF8):
+            data = data[3:]
+        return data, 'utf-8'
+    encoding = detect_encoding(data[:CHARDET_SAMPLE_SIZE])
+    try:
+        text = data.decode(encoding, errors='replace')
+    except LookupError:
+        text = data.decode('latin-1')
+    return text.encode('utf-8'), encoding
+
+def release_source(data):
+    if isinstance(data, memoryview):
+        mm = data.obj
+        data.release()
+        mm.close()
+
+# 清除注释前后的行号映射，行号都从1开始
+# 用 array 存储，old_to_new[i] 为旧的第 i 行对应的新行号（0 表示该行是注释或空行），new_to_old 反之
+# 可以像原来的 dict 一样使用：map[old_line] 得到新行号，注释或空行会抛出 KeyError
+class LineMap(Mapping):
+    def __init__(self, old_to_new:array, new_to_old:array) -> None:
+        self.old_to_new = old_to_new
+        self.new_to_old = new_to_old
+
+    def __getitem__(self, old_line:int) -> int:
+        if 0 < old_line < len(self.old_to_new) and self.old_to_new[old_line]:
+            return self.old_to_new[old_line]
+        raise KeyError(old_line)
+
+    def __iter__(self):
+        return (old_line for old_line in range(1, len(self.old_to_new)) if self.old_to_new[old_line])
+
+    def __len__(self):
+        return len(self.new_to_old) - 1
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    # 批量把旧行号转换为新行号，注释或空行为 None
+    def to_new(self, old_lines) -> list:
+        old_to_new = self.old_to_new
+        size = len(old_to_new)
+        return [old_to_new[line] or None if 0 < line < size else None for line in old_lines]
+
+    # 批量把新行号转换为旧行号，超出范围为 None
+    def to_old(self, new_lines) -> list:
+        new_to_old = self.new_to_old
+        size = len(new_to_old)
+        return [new_to_old[line] if 0 < line < size else None for line in new_lines]
+
+# 按行查找节点：nodes 互不重叠（如同一节点的子节点、全部函数定义），按位置排序后
+# 结束行也是非递减的，二分找到第一个结束行不小于目标行的节点，再检查开始行即可
+class LineIntervals():
+    def __init__(self, nodes:list[Node]) -> None:
+        self.nodes = sorted(nodes, key=lambda node: node.start_byte)
+        self.starts = [node.start_point[0] for node in self.nodes]
+        self.ends = [node.end_point[0] for node in self.nodes]
+
+    # 包含 line_index（从0开始）的节点，include_end 为 False 时不包含结束行
+    def find(self, line_index:int, include_end:bool = True):
+        if include_end:
+            i = bisect_left(self.ends, line_index)
+        else:
+            i = bisect_right(self.ends, line_index)
+        if i < len(self.nodes) and self.starts[i] <= line_index:
+            return self.nodes[i]
+        return None
+
+    def __len__(self):
+        return len(self.nodes)
+
+# 宏名的写法，与 QUERIES["macro_ids"] 中的 #match? 相同
+MACRO_ID_RE = re.compile(r'[A-Z_]+')
+
+# 一个文件中全部 identifier 和 type_identifier 的出现位置，执行一次 query 建立，按位置排序
+# 每次出现保存在并列的 array 中：名字、种类、字节范围、行列号（清除注释后，从0开始）、父节点类型
+# 按名字查找引用、查找某个节点或某几行中出现的名字时不再执行 query，也不保存 Node
+class OccurrenceIndex():
+    KINDS = ("identifier", "type_identifier")
+
+    def __init__(self, root_node:Node) -> None:
+        self.names = [] # 名字 id -> 名字
+        self.name_ids = {} # 名字 -> 名字 id
+        self.parent_types = [] # 父节点类型 id -> 父节点类型
+        parent_type_ids = {}
+        captures = get_query("occurrences").captures(root_node)
+        nodes = [(node, 0) for node in captures.get("identifier", [])] + \
+            [(node, 1) for node in captures.get("type_identifier", [])]
+        nodes.sort(key=lambda item: item[0].start_byte)
+        self.kinds = array('b')
+        self.name_of = array('i')
+        self.starts = array('q')
+        self.ends = array('q')
+        self.rows = array('i')
+        self.columns = array('i')
+        self.parent_of = array('i')
+        self.by_name = {} # 名字 id -> array('i')，该名字每次出现的下标
+        for i, (node, kind) in enumerate(nodes):
+            name = node.text.decode()
+            name_id = self.name_ids.get(name)
+            if name_id is None:
+                name_id = self.name_ids[name] = len(self.names)
+                self.names.append(name)
+                self.by_name[name_id] = array('i')
+            parent = node.parent
+            parent_type = parent.type if parent is not None else ""
+            parent_type_id = parent_type_ids.get(parent_type)
+            if parent_type_id is None:
+                parent_type_id = parent_type_ids[parent_type] = len(self.parent_types)
+                self.parent_types.append(parent_type)
+            self.kinds.append(kind)
+            self.name_of.append(name_id)
+            self.starts.append(node.start_byte)
+            self.ends.append(node.end_byte)
+            self.rows.append(node.start_point[0])
+            self.columns.append(node.start_point[1])
+            self.parent_of.append(parent_type_id)
+            self.by_name[name_id].append(i)
+        # 父节点类型 id 的集合，比较时不用再比较字符串
+        excluded = set(VAR_EXCLUDED_PARENT_TYPES)
+        self.var_excluded_parents = {parent_type_id for parent_type_id, parent_type in enumerate(self.parent_types) if parent_type in excluded}
+        self.macro_name_ids = {name_id for name_id, name in enumerate(self.names) if MACRO_ID_RE.fullmatch(name)}
+
+    def __len__(self):
+        return len(self.starts)
+
+    # 第 i 次出现 (名字, 种类, start_byte, end_byte, 行, 列, 父节点类型)
+    def get(self, i:int) -> tuple:
+        return (self.names[self.name_of[i]], self.KINDS[self.kinds[i]], self.starts[i], self.ends[i],
+            self.rows[i], self.columns[i], self.parent_types[self.parent_of[i]])
+
+    # 完全在 [start_byte, end_byte) 中的出现的下标
+    def indexes_in_range(self, start_byte:int, end_byte:int):
+        i = bisect_left(self.starts, start_byte)
+        j = bisect_left(self.starts, end_byte, i)
+        return (k for k in range(i, j) if self.ends[k] <= end_byte)
+
+    # [start_byte, end_byte) 中出现的名字，按位置排序，可以重复；kind 为 0（identifier）或 1（type_identifier）
+    # excluded_parents 为要跳过的父节点类型 id，name_ids 不为空时只保留其中的名字
+    def names_in_range(self, start_byte:int, end_byte:int, kind:int, excluded_parents:set = None, name_ids:set = None) -> list[str]:
+        names, kinds, name_of, parent_of = self.names, self.kinds, self.name_of, self.parent_of
+        return [names[name_of[k]] for k in self.indexes_in_range(start_byte, end_byte)
+            if kinds[k] == kind and (not excluded_parents or parent_of[k] not in excluded_parents)
+                and (name_ids is None or name_of[k] in name_ids)]
+
+    # 行号范围 [first_row, last_row]（从0开始）对应的字节范围
+    def row_range(self, first_row:int, last_row:int) -> tuple:
+        i = bisect_left(self.rows, first_row)
+        j = bisect_right(self.rows, last_row, i)
+        if i >= j:
+            return 0, 0
+        return self.starts[i], self.ends[j - 1]
+
+    # 名字的全部出现，kind 为空时不按种类过滤
+    def find(self, name:str, kind:str = "") -> list[tuple]:
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            return []
+        return [self.get(i) for i in self.by_name[name_id] if not kind or self.KINDS[self.kinds[i]] == kind]
+
+# 已解析 Cmodule 的进程级缓存，跨文件查找时同一个头文件只解析一次
+# key 为 (路径, mtime, size, project_dir)，文件被修改后 key 变化，旧实例随之淘汰
+# 按个数和估算内存两种上限做 LRU 淘汰
+class ModuleCache():
+    # 估算内存时，语法树按源码字节数的倍数计算
+    TREE_BYTES_PER_CODE_BYTE = 10
+
+    def __init__(self, max_entries:int = 512, max_bytes:int = 512 * 1024 * 1024) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # 多个线程同时 get 同一文件时只创建一个 Cmodule
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.modules = OrderedDict() # key -> (Cmodule, 估算字节数)
+            self.keys_by_path = {}
+            self.total_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    # Cmodule 的各阶段延迟执行，估算时不触发读取和解析，还没有清除注释时按文件大小估算
+    def estimate_size(self, module, file_size:int = 0) -> int:
+        if module._code_bytes is None:
+            code_bytes = 2 * file_size
+        else:
+            code_bytes = len(module._original_code_bytes or b'') + len(module._code_bytes)
+        return code_bytes * (1 + self.TREE_BYTES_PER_CODE_BYTE)
+
+    def get(self, path:str, project_dir:str = ""):
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, project_dir)
+        with self.lock:
+            if key in self.modules:
+                self.hits += 1
+                self.modules.move_to_end(key)
+                return self.modules[key][0]
+            self.misses += 1
+            module = Cmodule(path, project_dir)
+            self.put(key, module)
+            return module
+
+    def put(self, key, module):
+        with self.lock:
+            # 同一文件的旧版本直接丢弃
+            old_key = self.keys_by_path.get((key[0], key[3]))
+            if old_key is not None and old_key in self.modules:
+                self.total_bytes -= self.modules.pop(old_key)[1]
+                # 文件被修改过，它包含的头文件和其中的类型定义可能变化
+                invalidate_include_graph(key[3])
+                invalidate_type_resolver(key[3])
+            size = self.estimate_size(module, key[2])
+            self.modules[key] = (module, size)
+            self.keys_by_path[(key[0], key[3])] = key
+            self.total_bytes += size
+            # 至少保留刚放入的这一个
+            while len(self.modules) > 1 and \
+                (len(self.modules) > self.max_entries or self.total_bytes > self.max_bytes):
+                evicted_key, (_, evicted_size) = self.modules.popitem(last=False)
+                del self.keys_by_path[(evicted_key[0], evicted_key[3])]
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.modules),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+module_cache = ModuleCache()
+
+# 获取已解析的 Cmodule，文件未修改时直接复用缓存中的实例
+def get_cmodule(path:str, project_dir:str = ""):
+    return module_cache.get(path, project_dir)
+
+# 跨文件查找前的预过滤：文件的原始内容中没有这个 identifier 时，不需要解析它、也不需要执行 query
+# 每个文件只提取一次全部 identifier 形式的 token（包括注释和字符串中的，只会多、不会少），
+# 按 (路径, mtime, size) 缓存，之后每次判断都是一次集合查找
+TOKEN_RE = re.compile(rb'[A-Za-z_][A-Za-z0-9_]*')
+
+class IdentifierFilter():
+    def __init__(self, max_entries:int = 4096) -> None:
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.tokens = OrderedDict() # (path, mtime_ns, size) -> frozenset(token)，None 表示无法过滤
+            self.skips = 0
+            self.passes = 0
+
+    def get_tokens(self, path:str, project_dir:str = ""):
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            tokens = self.tokens.get(key, False)
+            if tokens is not False:
+                self.tokens.move_to_end(key)
+                return tokens
+        # module_cache 中已经读取过的文件直接用它的内容
+        data = None
+        with module_cache.lock:
+            cached_key = module_cache.keys_by_path.get((key[0], project_dir))
+            entry = module_cache.modules.get(cached_key) if cached_key is not None and cached_key[:3] == key else None
+        if entry is not None:
+            data = entry[0]._original_code_bytes
+        if data is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+        # UTF-16/32 等不兼容 ASCII 的编码无法按字节查找
+        if data.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)) or b'\x00' in data[:CHARDET_SAMPLE_SIZE]:
+            tokens = None
+        else:
+            tokens = frozenset(TOKEN_RE.findall(data))
+        with self.lock:
+            self.tokens[key] = tokens
+            while len(self.tokens) > self.max_entries:
+                self.tokens.popitem(last=False)
+        return tokens
+
+    # 文件中可能定义了 identifier 时返回 True
+    def may_contain(self, path:str, identifier:str, project_dir:str = "") -> bool:
+        tokens = self.get_tokens(path, project_dir)
+        res = tokens is None or identifier.encode('utf-8') in tokens
+        with self.lock:
+            if res:
+                self.passes += 1
+            else:
+                self.skips += 1
+        if instrumentation is not None:
+            instrumentation.count("prefilter_passes" if res else "prefilter_skips")
+        return res
+
+    def stats(self) -> dict:
+        checks = self.skips + self.passes
+        return {
+            "entries": len(self.tokens),
+            "skips": self.skips,
+            "passes": self.passes,
+            "skip_rate": self.skips / checks if checks else 0.0,
+        }
+
+identifier_filter = IdentifierFilter()
+# dosomething_in_headers 中可以预过滤的方法，第一个参数是要找的 identifier
+PREFILTER_METHODS = {"get_preproc_def", "get_enum_def", "get_struct_def"}
+
+# 符号提取方式变化时增加，旧版本的索引文件会被重建
+SYMBOL_INDEX_VERSION = 1
+
+# 持久化的项目符号索引（SQLite），记录每个文件定义的符号及其范围、每个文件包含的头文件
+# 进程重启后跨文件查找不需要重新解析整个 include 树，只在索引中按 key 读取
+# 文件的 mtime/size 变化时才重新计算内容 hash，hash 也变化才重新解析这个文件
+# 符号的字节和行范围都是相对于清除注释后的代码（Cmodule.code）
+class ProjectSymbolIndex():
+    def __init__(self, project_dir:str, db_path:str = "") -> None:
+        self.project_dir = os.path.abspath(project_dir)
+        if not db_path:
+            cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'cmodule')
+            os.makedirs(cache_dir, exist_ok=True)
+            name = hashlib.sha1(self.project_dir.encode()).hexdigest()
+            db_path = os.path.join(cache_dir, f'{name}.sqlite')
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        # 符号的提取方式变化后，旧版本的索引整个重建
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != SYMBOL_INDEX_VERSION:
+            self.db.executescript(f"""
+            DROP TABLE IF EXISTS files;
+            DROP TABLE IF EXISTS symbols;
+            DROP TABLE IF EXISTS includes;
+            PRAGMA user_version = {SYMBOL_INDEX_VERSION};
+            """)
+        self.db.executescript("""
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, hash TEXT);
+        CREATE TABLE IF NOT EXISTS symbols (
+            path TEXT, kind TEXT, name TEXT,
+            start_byte INTEGER, end_byte INTEGER, start_line INTEGER, end_line INTEGER);
+        CREATE INDEX IF NOT EXISTS symbols_name ON symbols (name, kind);
+        CREATE INDEX IF NOT EXISTS symbols_path ON symbols (path);
+        CREATE TABLE IF NOT EXISTS includes (
+            path TEXT, seq INTEGER, header TEXT, resolved TEXT);
+        CREATE INDEX IF NOT EXISTS includes_path ON includes (path);
+        """)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    # 重新索引项目中有变化的文件，删除已经不存在的文件
+    def update(self):
+        file_index = get_project_file_index(self.project_dir)
+        file_index.refresh()
+        with self.lock:
+            paths = set(os.path.abspath(path) for path in file_index.source_files)
+            for path in paths:
+                self.update_file(path, commit=False)
+            for (path,) in self.db.execute("SELECT path FROM files").fetchall():
+                if path not in paths:
+                    self.remove_file(path)
+            self.db.commit()
+
+    def remove_file(self, path:str):
+        with self.lock:
+            for table in ['files', 'symbols', 'includes']:
+                self.db.execute(f"DELETE FROM {table} WHERE path = ?", (path,))
+
+    # 保证索引中 path 的记录是最新的，module 为已经解析好的 Cmodule 时直接使用
+    def update_file(self, path:str, module = None, commit:bool = True):
+        path = os.path.abspath(path)
+        with self.lock:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self.remove_file(path)
+                return
+            row = self.db.execute(
+                "SELECT mtime_ns, size, hash FROM files WHERE path = ?", (path,)).fetchone()
+            if row and row[0] == stat.st_mtime_ns and row[1] == stat.st_size:
+                return
+            with open(path, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+            if row and row[2] == digest:
+                self.db.execute("UPDATE files SET mtime_ns = ?, size = ? WHERE path = ?",
+                    (stat.st_mtime_ns, stat.st_size, path))
+            else:
+                if module is None:
+                    module = get_cmodule(path, self.project_dir)
+                # 文件包含的头文件可能变化，之前算出的搜索顺序作废
+                invalidate_include_graph(self.project_dir)
+                self.remove_file(path)
+                self.db.execute("INSERT INTO files VALUES (?, ?, ?, ?)",
+                    (path, stat.st_mtime_ns, stat.st_size, digest))
+                symbols = module.get_symbols()
+                for kind, named_nodes in symbols.items():
+                    if not isinstance(named_nodes, dict):
+                        continue
+                    self.db.executemany("INSERT INTO symbols VALUES (?, ?, ?, ?, ?, ?, ?)", [
+                        (path, kind, name, node.start_byte, node.end_byte, node.start_point[0], node.end_point[0])
+                        for name, nodes in named_nodes.items() for node in nodes])
+                headers = module.get_all_headers()
+                self.db.executemany("INSERT INTO includes VALUES (?, ?, ?, ?)", [
+                    (path, seq, header, module.get_header_path(header))
+                    for seq, header in enumerate(headers)])
+            if commit:
+                self.db.commit()
+
+    # 文件中包含的头文件的路径（按包含顺序，找不到的为 ""）
+    def get_includes(self, path:str) -> list[str]:
+        path = os.path.abspath(path)
+        self.update_file(path)
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT resolved FROM includes WHERE path = ? ORDER BY seq", (path,)).fetchall()
+        return [os.path.abspath(resolved) if resolved else "" for (resolved,) in rows]
+
+    # 定义了指定符号的全部文件，以及符号在文件中的范围
+    def lookup(self, kind:str, name:str) -> list[tuple]:
+        with self.lock:
+            return self.db.execute(
+                "SELECT path, start_byte, end_byte, start_line, end_line FROM symbols"
+                " WHERE name = ? AND kind = ?", (name, kind)).fetchall()
+
+    # 按与 dosomething_in_headers 相同的顺序（IncludeGraph 的搜索顺序）
+    # 在 path 包含的头文件中找第一个定义了该符号的文件，找不到返回 ""
+    def find_definition_file(self, path:str, kind:str, name:str, max_depth:int = MAX_DEPTH) -> str:
+        for header_path in get_include_graph(self.project_dir).get_search_order(path, max_depth):
+            self.update_file(header_path)
+            if self.lookup_in_file(header_path, kind, name):
+                return header_path
+        return ""
+
+    def lookup_in_file(self, path:str, kind:str, name:str) -> bool:
+        with self.lock:
+            return self.db.execute(
+                "SELECT 1 FROM symbols WHERE path = ? AND kind = ? AND name = ? LIMIT 1",
+                (path, kind, name)).fetchone() is not None
+
+# project_dir -> ProjectSymbolIndex，只有打开过索引的项目才会在查找时使用
+project_symbol_indexes = {}
+
+# 打开（不存在则新建）项目的持久化符号索引，build 为 True 时立即索引整个项目
+def open_project_symbol_index(project_dir:str, db_path:str = "", build:bool = False) -> ProjectSymbolIndex:
+    key = os.path.abspath(project_dir)
+    with registry_lock:
+        index = project_symbol_indexes.get(key)
+        if index is None:
+            index = project_symbol_indexes[key] = ProjectSymbolIndex(key, db_path)
+    if build:
+        index.update()
+    return index
+
+def get_project_symbol_index(project_dir:str):
+    if not project_dir:
+        return None
+    return project_symbol_indexes.get(os.path.abspath(project_dir))
+
+# 项目的 include 图：节点是文件，边是 #include 解析出的头文件路径
+# 每个文件的头文件搜索顺序（广度优先，去重）只计算一次并缓存，
+# 环状包含和菱形包含中的头文件只会出现一次
+# 项目打开了符号索引时，直接从索引中读取每个文件包含的头文件，不需要解析
+class IncludeGraph():
+    def __init__(self, project_dir:str) -> None:
+        self.project_dir = os.path.abspath(project_dir)
+        self.lock = threading.RLock()
+        self.includes = {} # path -> (mtime_ns, [头文件路径])
+        self.invalidate()
+
+    # 清空已经算出的搜索顺序和环，项目中的文件变化后调用
+    def invalidate(self):
+        with self.lock:
+            # (path, max_depth) -> ([头文件路径], [头文件所在的层数], [(展开过的文件, mtime_ns)])
+            self.search_orders = {}
+            self.cycles = {} # path -> [[环上的文件路径]]
+
+    # 文件直接包含的、能在项目中找到的头文件，按包含顺序去重
+    def get_includes(self, path:str) -> list[str]:
+        path = os.path.abspath(path)
+        index = get_project_symbol_index(self.project_dir)
+        if index is not None:
+            header_paths = index.get_includes(path)
+        else:
+            mtime_ns = os.stat(path).st_mtime_ns
+            with self.lock:
+                cached = self.includes.get(path)
+            if cached and cached[0] == mtime_ns:
+                return cached[1]
+            module = get_cmodule(path, self.project_dir)
+            header_paths = [module.get_header_path(header) for header in module.get_all_headers()]
+        res = []
+        for header_path in header_paths:
+            if header_path:
+                header_path = os.path.abspath(header_path)
+                if header_path not in res:
+                    res.append(header_path)
+        if index is None:
+            with self.lock:
+                self.includes[path] = (mtime_ns, res)
+        return res
+
+    # 缓存的搜索顺序是否仍然有效：读取过 include 的文件都没有被修改或删除
+    # 头文件被修改后不一定会再被加载（identifier_filter 会跳过它），所以每次使用前都检查 mtime
+    def is_fresh(self, stamps:list[tuple]) -> bool:
+        for file_path, mtime_ns in stamps:
+            try:
+                if os.stat(file_path).st_mtime_ns != mtime_ns:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    # 头文件的搜索顺序：广度优先，越近的头文件越先搜索，最多 max_depth 层，None 表示不限层数
+    def get_search_order(self, path:str, max_depth = MAX_DEPTH) -> list[str]:
+        return self.get_search_entry(path, max_depth)[0]
+
+    # (搜索顺序, 层数, 展开过的文件和 mtime)，缓存的结果中有文件被修改时重新计算
+    def get_search_entry(self, path:str, max_depth = MAX_DEPTH) -> tuple:
+        path = os.path.abspath(path)
+        key = (path, max_depth)
+        with self.lock:
+            entry = self.search_orders.get(key)
+        if entry is not None and self.is_fresh(entry[2]):
+            return entry
+        order = []
+        depths = []
+        stamps = []
+        visited = {path}
+        frontier = [path]
+        depth = 0
+        while frontier and (max_depth is None or depth < max_depth):
+            next_frontier = []
+            for current in frontier:
+                # 先取 mtime 再读取 include，读取期间被修改时下次使用会重新计算
+                try:
+                    stamps.append((current, os.stat(current).st_mtime_ns))
+                except OSError:
+                    stamps.append((current, None))
+                for header_path in self.get_includes(current):
+                    if header_path in visited:
+                        continue
+                    visited.add(header_path)
+                    order.append(header_path)
+                    depths.append(depth + 1)
+                    next_frontier.append(header_path)
+            frontier = next_frontier
+            depth += 1
+        entry = (order, depths, stamps)
+        with self.lock:
+            self.search_orders[key] = entry
+        return entry
+
+    # 搜索顺序中每个头文件所在的层数，直接包含的为 1
+    def get_search_depths(self, path:str, max_depth = MAX_DEPTH) -> list[int]:
+        return self.get_search_entry(path, max_depth)[1]
+
+    # 文件直接和间接包含的全部头文件
+    def get_transitive_includes(self, path:str) -> set[str]:
+        return set(self.get_search_order(path, None))
+
+    # 从 path 出发能走到的所有 include 环，每个环是首尾相接的文件路径列表
+    def find_cycles(self, path:str) -> list[list[str]]:
+        path = os.path.abspath(path)
+        with self.lock:
+            if path in self.cycles:
+                return self.cycles[path]
+        cycles = []
+        # 深度优先，stack 中是当前路径上的 (文件, 下一个要访问的头文件下标)
+        on_stack = {path: 0}
+        done = set()
+        stack = [(path, 0)]
+        while stack:
+            current, i = stack[-1]
+            includes = self.get_includes(current)
+            if i >= len(includes):
+                stack.pop()
+                del on_stack[current]
+                done.add(current)
+                continue
+            stack[-1] = (current, i + 1)
+            header_path = includes[i]
+            if header_path in on_stack:
+                cycle = [node for node, _ in stack[on_stack[header_path]:]]
+                cycles.append(cycle + [header_path])
+            elif header_path not in done:
+                on_stack[header_path] = len(stack)
+                stack.append((header_path, 0))
+        with self.lock:
+            self.cycles[path] = cycles
+        return cycles
+
+# project_dir -> IncludeGraph
+include_graphs = {}
+
+def get_include_graph(project_dir:str) -> IncludeGraph:
+    key = os.path.abspath(project_dir)
+    graph = include_graphs.get(key)
+    if graph is None:
+        with registry_lock:
+            graph = include_graphs.get(key)
+            if graph is None:
+                graph = include_graphs[key] = IncludeGraph(key)
+    return graph
+
+def invalidate_include_graph(project_dir:str):
+    graph = include_graphs.get(os.path.abspath(project_dir)) if project_dir else None
+    if graph is not None:
+        graph.invalidate()
+
+# 类型解析：typedef 链解析到最终的 struct/union/enum 定义或基本类型，结果按类型名缓存
+# 缓存中只保存文本和字段表，不保存 Node，文件的语法树被释放后仍然可用
+# 类型名写法中去掉的修饰，如 const struct foo * -> struct foo
+TYPE_QUALIFIER_RE = re.compile(r'\b(?:const|volatile|restrict)\b|\*')
+# struct/union/enum 的 tag 和 typedef 的名字是两个命名空间，typedef struct node node; 中两个 node 不是同一个名字
+TAG_KEYWORDS = ("struct", "union", "enum")
+# 成员访问表达式的分隔符，a.b->c -> [a, b, c]
+MEMBER_ACCESS_RE = re.compile(r'\s*(?:\.|->)\s*')
+# 找不到定义时，全部由这些词组成的类型名视为基本类型
+BASE_TYPE_WORDS = {"void", "char", "short", "int", "long", "float", "double", "signed", "unsigned", "_Bool", "bool", "_Complex"}
+STRUCT_SPECIFIER_TYPES = ('struct_specifier', 'union_specifier', 'enum_specifier')
+PREPROC_BLOCK_TYPES = ('preproc_if', 'preproc_ifdef', 'preproc_else', 'preproc_elif')
+
+# 解析后的类型
+class TypeInfo():
+    __slots__ = ("name", "kind", "path", "text", "fields")
+
+    def __init__(self, name:str, kind:str, path:str = "", text:str = "", fields:dict = None) -> None:
+        self.name = name # struct/union/enum 的名字（匿名时为 typedef 的名字或 ""），基本类型为类型名
+        self.kind = kind # "struct"、"union"、"enum" 或 "primitive"
+        self.path = path # 定义所在的文件，基本类型为 ""
+        self.text = text # 定义的文本（清除注释后）
+        self.fields = fields # struct/union 的字段表 name -> FieldInfo，匿名成员的字段直接合并进来
+
+    def __repr__(self) -> str:
+        return f"TypeInfo({self.name!r}, {self.kind!r}, {self.path!r})"
+
+# struct/union 中的一个字段
+class FieldInfo():
+    __slots__ = ("name", "type_name", "type_text", "pointer", "text", "type_info")
+
+    def __init__(self, name:str, type_name:str, type_text:str, pointer:int, text:str) -> None:
+        self.name = name
+        self.type_name = type_name # 用于解析字段类型的名字，如 foo_t 或 struct foo
+        self.type_text = type_text # 字段声明中类型的原文，与 get_field_type_in_struct 的结果相同
+        self.pointer = pointer # 声明符中指针和数组的层数
+        self.text = text # 字段声明的文本
+        self.type_info = None # 字段类型的 TypeInfo，第一次解析成功后由 TypeResolver.get_field_type 保存
+
+    def __repr__(self) -> str:
+        return f"FieldInfo({self.name!r}, {self.type_text!r}, {self.pointer})"
+
+class TypeResolver():
+    def __init__(self, project_dir:str = "") -> None:
+        self.project_dir = os.path.abspath(project_dir) if project_dir else ""
+        self.invalidate()
+
+    # 项目中的文件变化后调用，只替换字典，正在进行的解析仍然使用旧的字典
+    # 并发解析同一类型时最多重复计算，所以不加锁
+    # 找不到的类型不缓存：不同文件的 include 树不同，在一个文件中找不到的类型在另一个文件中可能找得到
+    # namespace 为 "tag"（struct foo 中的 foo）或 "name"（typedef 的名字），基本类型的 namespace 和文件都为 ""
+    def invalidate(self):
+        self.types = {} # (定义所在文件, namespace, 类型名) -> TypeInfo
+        self.locations = {} # (解析所在文件, namespace, 类型名) -> 定义所在文件，只记录找到的
+
+    # 一个文件中的定义节点：tag 为带 body 的 struct/union/enum，name 为 typedef
+    def get_type_nodes(self, module, name:str, namespace:str) -> list[Node]:
+        symbols = module.get_symbols()
+        if namespace == "name":
+            return [node for node in symbols["type"].get(name, []) if node.type == 'type_definition']
+        nodes = [node for node in symbols["type"].get(name, []) if node.type in STRUCT_SPECIFIER_TYPES]
+        for node in symbols["enum"]:
+            name_node = node.child_by_field_name('name')
+            if name_node is not None and name_node.text.decode() == name:
+                nodes.append(node)
+        return nodes
+
+    # 在 module 及其 include 树中找类型名的定义节点，返回 (所在文件, [node])
+    def find_type_nodes(self, module, name:str, namespace:str) -> tuple:
+        nodes = self.get_type_nodes(module, name, namespace)
+        if nodes:
+            return module.path, nodes
+        if module.is_path and self.project_dir:
+            for header_path in get_include_graph(self.project_dir).get_search_order(module.path, MAX_DEPTH):
+                if not identifier_filter.may_contain(header_path, name, self.project_dir):
+                    continue
+                nodes = self.get_type_nodes(get_cmodule(header_path, self.project_dir), name, namespace)
+                if nodes:
+                    return header_path, nodes
+        return "", []
+
+    # 同名的多个定义中优先选择带有 body 的
+    def pick_definition(self, nodes:list[Node]) -> Node:
+        for node in nodes:
+            type_node = node.child_by_field_name('type') if node.type == 'type_definition' else node
+            if type_node is not None and type_node.child_by_field_name('body') is not None:
+                return node
+        return nodes[0]
+
+    def get_primitive(self, name:str) -> TypeInfo:
+        key = ("", "", name)
+        info = self.types.get(key)
+        if info is None:
+            info = self.types[key] = TypeInfo(name, "primitive")
+        return info
+
+    # 类型名的写法可以带 const、* 等修饰，带 struct/union/enum 时按 tag 查找
+    def resolve(self, module, type_name:str):
+        words = TYPE_QUALIFIER_RE.sub(' ', type_name).split()
+        if len(words) > 1 and words[0] in TAG_KEYWORDS:
+            return self.resolve_name(module, ' '.join(words[1:]), set(), "tag")
+        if not words:
+            return None
+        return self.resolve_name(module, ' '.join(words), set())
+
+    # 同一个文件中再次解析同一类型名时直接由 locations 找到定义所在的文件
+    def resolve_name(self, module, name:str, visiting:set, namespace:str = "name"):
+        types, locations = self.types, self.locations
+        location_key = (module.path, namespace, name)
+        path = locations.get(location_key)
+        if path is not None:
+            info = types.get((path, namespace, name))
+            if info is not None:
+                return info
+        # typedef a b; typedef b a; 这样的环
+        if (namespace, name) in visiting:
+            return None
+        visiting.add((namespace, name))
+        path, nodes = self.find_type_nodes(module, name, namespace)
+        if not nodes:
+            if namespace == "tag":
+                return None
+            if set(name.split()) <= BASE_TYPE_WORDS:
+                return self.get_primitive(name)
+            # 没有这个名字的 typedef 时按 tag 查找，兼容 get_field_type_in_struct('foo', ...) 这样不带 struct 的写法
+            return self.resolve_name(module, name, visiting, "tag")
+        key = (path, namespace, name)
+        info = types.get(key)
+        if info is None:
+            node = self.pick_definition(nodes)
+            if node.type == 'type_definition':
+                info = self.resolve_node(module, node.child_by_field_name('type'), path, name, visiting)
+            else:
+                info = self.build_type(node, name, path)
+            if info is None:
+                return None
+            types[key] = info
+        locations[location_key] = path
+        return info
+
+    # 由类型节点（声明或 typedef 中的 type）解析，alias 为匿名 struct 使用的名字
+    def resolve_node(self, module, type_node:Node, path:str = "", alias:str = "", visiting:set = None):
+        if type_node is None:
+            return None
+        if visiting is None:
+            visiting = set()
+        if type_node.type in STRUCT_SPECIFIER_TYPES:
+            name_node = type_node.child_by_field_name('name')
+            if type_node.child_by_field_name('body') is not None:
+                return self.build_type(type_node, name_node.text.decode() if name_node else alias, path)
+            if name_node is None:
+                return None
+            return self.resolve_name(module, name_node.text.decode(), visiting, "tag")
+        if type_node.type == 'type_identifier':
+            return self.resolve_name(module, type_node.text.decode(), visiting)
+        if type_node.type in ('primitive_type', 'sized_type_specifier'):
+            return self.get_primitive(' '.join(type_node.text.decode().split()))
+        return None
+
+    def build_type(self, node:Node, name:str, path:str) -> TypeInfo:
+        kind = node.type.split('_')[0]
+        fields = None
+        if kind in ("struct", "union"):
+            fields = {}
+            body = node.child_by_field_name('body')
+            if body is not None:
+                self.collect_fields(body, fields, path)
+        return TypeInfo(name, kind, path, node.text.decode(), fields)
+
+    def collect_fields(self, body:Node, fields:dict, path:str):
+        for child in body.named_children:
+            if child.type in PREPROC_BLOCK_TYPES:
+                self.collect_fields(child, fields, path)
+                continue
+            if child.type != 'field_declaration':
+                continue
+            type_node = child.child_by_field_name('type')
+            if type_node is None:
+                continue
+            declarators = child.children_by_field_name('declarator')
+            inline_type = None
+            if type_node.type in STRUCT_SPECIFIER_TYPES and type_node.child_by_field_name('body') is not None:
+                inline_type = self.build_type(type_node, "", path)
+                # 匿名成员 struct { int x; }; 的字段可以直接访问
+                if not declarators and inline_type.fields:
+                    for field_name, field in inline_type.fields.items():
+                        fields.setdefault(field_name, field)
+            if type_node.type in STRUCT_SPECIFIER_TYPES:
+                type_name_node = type_node.child_by_field_name('name')
+                type_name = f"{type_node.type.split('_')[0]} {type_name_node.text.decode()}" if type_name_node else ""
+            else:
+                type_name = ' '.join(type_node.text.decode().split())
+            for declarator in declarators:
+                pointer = 0
+                while declarator is not None and declarator.type != 'field_identifier':
+                    if declarator.type in ('pointer_declarator', 'array_declarator'):
+                        pointer += 1
+                    next_declarator = declarator.child_by_field_name('declarator')
+                    if next_declarator is None and declarator.named_child_count:
+                        next_declarator = declarator.named_child(0)
+                    declarator = next_declarator
+                if declarator is None:
+                    continue
+                field = FieldInfo(declarator.text.decode(), type_name, type_node.text.decode(), pointer, child.text.decode())
+                if inline_type is not None:
+                    field.type_info = inline_type
+                fields.setdefault(field.name, field)
+
+    # 字段类型的 TypeInfo，在 module 的 include 树中解析，解析成功后保存在字段上；找不到时不保存，换一个文件可以再解析
+    def get_field_type(self, module, field:FieldInfo):
+        if field.type_info is None and field.type_name:
+            field.type_info = self.resolve(module, field.type_name)
+        return field.type_info
+
+    # 从 info 出发依次访问字段，返回每一步的 FieldInfo，中途找不到时返回 None
+    # 每一步是字段表中的一次查找，字段类型解析过之后直接使用
+    def resolve_fields(self, module, info, field_names:list[str]):
+        res = []
+        for field_name in field_names:
+            if info is None or not info.fields:
+                return None
+            field = info.fields.get(field_name)
+            if field is None:
+                return None
+            res.append(field)
+            info = self.get_field_type(module, field)
+        return res
+
+# project_dir -> TypeResolver
+type_resolvers = {}
+
+def get_type_resolver(project_dir:str) -> TypeResolver:
+    key = os.path.abspath(project_dir)
+    resolver = type_resolvers.get(key)
+    if resolver is None:
+        with registry_lock:
+            resolver = type_resolvers.get(key)
+            if resolver is None:
+                resolver = type_resolvers[key] = TypeResolver(key)
+    return resolver
+
+def invalidate_type_resolver(project_dir:str):
+    resolver = type_resolvers.get(os.path.abspath(project_dir)) if project_dir else None
+    if resolver is not None:
+        resolver.invalidate()
+
+# 可选的性能统计：方法调用次数和耗时、query 编译次数、解析的文件数、跨文件查找的次数和最大层数、各缓存的命中率
+# 默认关闭（instrumentation 为 None）：方法不被包装，各处的统计点只判断一次 None
+# 开启后包装 instrumented_targets 中的方法，耗时包含其内部调用的其他方法
+class Instrumentation():
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = {} # 名字 -> [调用次数, 总耗时, 最长一次耗时]
+            self.counters = {} # 名字 -> 次数
+            self.max_header_depth = 0
+
+    def count(self, name:str, n:int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record_call(self, name:str, seconds:float):
+        with self.lock:
+            call = self.calls.get(name)
+            if call is None:
+                self.calls[name] = [1, seconds, seconds]
+            else:
+                call[0] += 1
+                call[1] += seconds
+                call[2] = max(call[2], seconds)
+
+    # 跨文件查找了一个头文件，depth 为它在 include 树中的层数，未知时为 None
+    def record_hop(self, depth):
+        with self.lock:
+            self.counters["header_hops"] = self.counters.get("header_hops", 0) + 1
+            if depth is not None and depth > self.max_header_depth:
+                self.max_header_depth = depth
+
+    def wrap(self, name:str, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record_call(name, time.perf_counter() - start)
+        return wrapper
+
+    def hit_rate(self, hits_name:str, misses_name:str) -> dict:
+        hits = self.counters.get(hits_name, 0)
+        misses = self.counters.get(misses_name, 0)
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        }
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            calls = {name: {"count": count, "seconds": seconds, "max_seconds": max_seconds}
+                for name, (count, seconds, max_seconds) in self.calls.items()}
+            counters = dict(self.counters)
+        return {
+            "calls": calls,
+            "counters": counters,
+            "files_parsed": counters.get("files_parsed", 0),
+            "queries_compiled": counters.get("query_cache_misses", 0),
+            "header_hops": counters.get("header_hops", 0),
+            "max_header_depth": self.max_header_depth,
+            "caches": {
+                "module_cache": module_cache.stats(),
+                "queries": self.hit_rate("query_cache_hits", "query_cache_misses"),
+                "file_index": self.hit_rate("file_index_hits", "file_index_misses"),
+                "prefilter": identifier_filter.stats(),
+            },
+        }
+
+    # 每行一条记录：{"type": "call", "name", "count", "seconds", "max_seconds"}、
+    # {"type": "counter", "name", "value"}、{"type": "cache", "name", "hits", "misses", "hit_rate", ...}
+    def to_jsonl(self, file = None) -> str:
+        data = self.to_dict()
+        records = [{"type": "call", "name": name, **call} for name, call in data["calls"].items()]
+        records += [{"type": "counter", "name": name, "value": value} for name, value in data["counters"].items()]
+        records += [{"type": "counter", "name": name, "value": data[name]}
+            for name in ["files_parsed", "queries_compiled", "max_header_depth"]]
+        records += [{"type": "cache", "name": name, **stats} for name, stats in data["caches"].items()]
+        text = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+        if file is not None:
+            if isinstance(file, str):
+                with open(file, 'a') as f:
+                    f.write(text)
+            else:
+                file.write(text)
+        return text
+
+instrumentation = None
+instrumented_originals = [] # [(对象, 属性名, 原函数)]，关闭时恢复
+
+# 默认统计的方法：Cmodule 的全部方法，以及读取、编码检测、目录遍历、缓存和 include 图中的主要步骤
+def instrumented_targets() -> list[tuple]:
+    module = sys.modules[__name__]
+    targets = [(Cmodule, name, f"Cmodule.{name}") for name, value in vars(Cmodule).items()
+        if callable(value) and (name == "__init__" or not name.startswith("__"))]
+    targets += [
+        (module, "read_source", "read_source"),
+        (module, "detect_encoding", "detect_encoding"),
+        (module, "resolve_header_path", "resolve_header_path"),
+        (ProjectFileIndex, "refresh", "ProjectFileIndex.refresh"),
+        (ModuleCache, "get", "ModuleCache.get"),
+        (IncludeGraph, "get_includes", "IncludeGraph.get_includes"),
+        (IncludeGraph, "get_search_order", "IncludeGraph.get_search_order"),
+        (ProjectSymbolIndex, "update_file", "ProjectSymbolIndex.update_file"),
+        (ProjectSymbolIndex, "find_definition_file", "ProjectSymbolIndex.find_definition_file"),
+    ]
+    return targets
+
+# 开启统计，targets 为 [(对象, 属性名, 统计用的名字)]，默认为 instrumented_targets()
+def enable_instrumentation(targets:list[tuple] = None) -> Instrumentation:
+    global instrumentation
+    if instrumentation is not None:
+        return instrumentation
+    instrumentation = Instrumentation()
+    for owner, attr, name in targets or instrumented_targets():
+        original = getattr(owner, attr)
+        instrumented_originals.append((owner, attr, original))
+        setattr(owner, attr, instrumentation.wrap(name, original))
+    return instrumentation
+
+# 关闭统计并恢复原来的方法，返回关闭前的统计结果
+def disable_instrumentation():
+    global instrumentation
+    res = instrumentation
+    while instrumented_originals:
+        owner, attr, original = instrumented_originals.pop()
+        setattr(owner, attr, original)
+    instrumentation = None
+    return res
+
+# with instrument() as stats: ...，结束后 stats 中保留统计结果
+@contextlib.contextmanager
+def instrument(targets:list[tuple] = None):
+    stats = enable_instrumentation(targets)
+    try:
+        yield stats
+    finally:
+        disable_instrumentation()
+
+# 在实例的锁内执行的方法
+def locked(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
 class Cmodule():
     def __init__(self, input:str, project_dir:str = "") -> None:
         self.project_dir = project_dir
-        self.clear_comments_line_map = {}
         self.is_path = False 
+        # 各阶段都在第一次使用时才执行，结果保存下来：
+        # 1. 读取文件、判断编码：original_code_bytes、encoding
+        # 2. 清除注释：code_bytes、clear_comments_line_map
+        # 3. 解析：tree、root_node
+        # 源码全程以 UTF-8 bytes 保存，code 和 original_code 在第一次访问时才解码成 str
+        self._code = self._original_code = None
+        self._original_code_bytes = self._code_bytes = None
+        self._encoding = None
+        self._line_map = None
+        self._tree = self._root_node = None
+        # 同一实例可以被多个线程使用（module_cache 中的实例是共享的）：
+        # 读取、清除注释、解析和建立符号表在锁内执行，每个阶段只执行一次；
+        # 其他缓存只在计算完成后整体赋值，并发时最多重复计算，不会读到一半的结果
+        self.lock = threading.RLock()
         if os.path.exists(input) and (input.endswith('.c') or input.endswith('.h')):
-            raw_data = open(input,'rb').read()
-            encoding = chardet.detect(raw_data)['encoding']
-            self.code = self.original_code = raw_data.decode(encoding)
             self.path = input
             if not project_dir:
                 projects_dir = '/public/github_repos/github_repos_c'
@@ -35,88 +1456,386 @@ class Cmodule():
             else:
                 self.is_path = True # 可以跨文件
         else:
-            self.code = input
+            self._original_code_bytes = input.encode('utf-8')
+            self._encoding = 'utf-8'
             self.is_path = False # 不可跨文件
             self.path = ""
             print("未给出路径，不可跨文件查找！")
-        # 清除代码中的comments,且得到
-        # self.clear_comments_line_map 一个从清除前代码行到清楚后代码行的映射（如果清除前是comment或者空行则会报错）
-        self.clear_code()
-        tree = parser.parse(bytes(self.code,'utf8'))
-        self.root_node = tree.root_node
-        self.libs = {} # 缓存， 之后可以改成同一项目所有文件共享一个缓存，也许可以设置一个缓存文件
+        # 增量更新用的状态，第一次 update 时才建立，见 update
+        self.literal_spans = None
+        self.line_starts = None
+        self.has_lone_cr = False
+        self.reset_node_caches()
+
+    # 所有保存了 Node 或由 Node 计算得到的缓存，语法树改变后需要清空，之后按需重新建立
+    def reset_node_caches(self):
         self.all_function_nodes = []
         self.all_function_declaration_nodes = []
+        self.symbols = None
+        # 按行查找用的区间索引，key 为 "function"、"macro" 或节点的 id（该节点的 named_children）
+        self.line_intervals = {}
+        self.line_count = None
+        # 变量声明，key 为节点的 id，见 get_var_declarations
+        self.var_declarations = {}
+        # 见 get_usage_sets 和 get_header_exports
+        self.usage_sets = None
+        self.header_exports = None
+        # 不能跨文件的实例自己的 TypeResolver，见 get_type_resolver
+        self.type_resolver = None
+        # 见 get_occurrence_index
+        self.occurrence_index = None
         
-    def clear_code(self):
-        def replace_multiline_comment(match):
-            comment = match.group(0)
-            lines = comment.count('\n')
-            return '\n' * lines
-        code = self.code
+    # 释放语法树和所有由 Node 计算得到的缓存，已经提取出需要的信息（如 project_index.FactStore）后调用
+    # 文件来源且没有 update 过的实例还会释放源码，之后再使用时各阶段重新从文件读取、清除注释和解析
+    @locked
+    def release_tree(self):
+        self.tree = None
+        self.reset_node_caches()
+        self._code = self._original_code = None
+        if self.path and self.literal_spans is None:
+            self._original_code_bytes = self._code_bytes = None
+            self._line_map = None
+
+    # 读取文件并清除注释
+    # 大文件用 mmap 读取时不保留原始内容，直接在映射的内存上清除注释，需要时再从文件读取
+    def load_code(self):
+        with self.lock:
+            # 其他线程已经完成
+            if self._code_bytes is not None and self._line_map is not None:
+                return
+            if self._original_code_bytes is not None:
+                raw_data = self._original_code_bytes
+            else:
+                raw_data, self._encoding = read_source(self.path, use_mmap=True)
+                if isinstance(raw_data, bytes):
+                    self._original_code_bytes = raw_data
+            # 清除代码中的comments,且得到
+            # self.clear_comments_line_map 一个从清除前代码行到清楚后代码行的映射（如果清除前是comment或者空行则会报错）
+            # 见 LineMap，还可以用 to_new/to_old 批量转换行号
+            self.clear_code(raw_data)
+            release_source(raw_data)
+
+    # UTF-8 编码的原始代码
+    @property
+    def original_code_bytes(self) -> bytes:
+        if self._original_code_bytes is None:
+            self._original_code_bytes, self._encoding = read_source(self.path)
+        return self._original_code_bytes
+
+    @original_code_bytes.setter
+    def original_code_bytes(self, data:bytes):
+        self._original_code_bytes = data
+        self._original_code = None
+
+    # 原文件的编码
+    @property
+    def encoding(self) -> str:
+        if self._encoding is None:
+            self._original_code_bytes, self._encoding = read_source(self.path)
+        return self._encoding
+
+    # UTF-8 编码的、清除注释后的代码
+    @property
+    def code_bytes(self) -> bytes:
+        if self._code_bytes is None:
+            self.load_code()
+        return self._code_bytes
+
+    @code_bytes.setter
+    def code_bytes(self, data:bytes):
+        self._code_bytes = data
+        self._code = None
+
+    @property
+    def clear_comments_line_map(self):
+        if self._line_map is None:
+            self.load_code()
+        return self._line_map
+
+    @clear_comments_line_map.setter
+    def clear_comments_line_map(self, line_map):
+        self._line_map = line_map
+
+    # 语法树
+    @property
+    def tree(self):
+        if self._tree is None:
+            with self.lock:
+                if self._tree is None:
+                    if instrumentation is not None:
+                        instrumentation.count("files_parsed")
+                    self._tree = get_parser().parse(self.code_bytes)
+        return self._tree
+
+    @tree.setter
+    def tree(self, tree):
+        self._tree = tree
+        self._root_node = None
+
+    @property
+    def root_node(self) -> Node:
+        if self._root_node is None:
+            self._root_node = self.tree.root_node
+        return self._root_node
+
+    # 清除注释后的代码
+    @property
+    def code(self) -> str:
+        if self._code is None:
+            self._code = self.code_bytes.decode('utf-8')
+        return self._code
+
+    @code.setter
+    def code(self, code:str):
+        self.code_bytes = code.encode('utf-8')
+        self._code = code
+
+    # 原始代码
+    @property
+    def original_code(self) -> str:
+        if self._original_code is None:
+            if self._original_code_bytes is not None:
+                self._original_code = self._original_code_bytes.decode('utf-8')
+            else:
+                # 不保留大文件的原始内容
+                data, self._encoding = read_source(self.path)
+                self._original_code = data.decode('utf-8')
+        return self._original_code
+
+    @original_code.setter
+    def original_code(self, original_code:str):
+        self.original_code_bytes = original_code.encode('utf-8')
+        self._original_code = original_code
+
+    # source 为 UTF-8 编码的原始代码，默认为 original_code_bytes
+    def clear_code(self, source = None):
+        def replace_comment(match):
+            text = match.group(0)
+            # 字符串和字符字面量保持不变
+            if text[:1] in (b'"', b"'"):
+                return text
+            # 注释只保留其中的换行，保证行号不变
+            return b'\n' * text.count(b'\n')
+        if source is None:
+            source = self.original_code_bytes
         # 旧行
-        old_code = re.sub(r'/\*[\s\S]*?\*/', replace_multiline_comment, code)
-        old_code = re.sub(r'//.*', '', old_code)
+        old_code = COMMENT_OR_LITERAL_RE.sub(replace_comment, source)
         old_lines = old_code.splitlines()
-        # 移除空行, 得到新行
-        new_lines = [line for line in old_lines if line.strip()]
-        # 计算新的行号
-        new_line = 0
-        old_line = 0
-    
-        while old_line < len(old_lines) and new_line < len(new_lines):
-            if old_lines[old_line].strip() == new_lines[new_line].strip():
-                self.clear_comments_line_map[old_line + 1] = new_line + 1
-                old_line += 1
-                new_line += 1
-            else: 
-                old_line += 1
-        self.code = '\n'.join(new_lines)
-    
-    # 这是个笨方法，如果能够缩小遍历范围更快
+        # 移除空行, 得到新行，同时记录新旧行号的对应关系
+        new_lines = []
+        old_to_new = array('i', bytes(4 * (len(old_lines) + 1)))
+        new_to_old = array('i', [0])
+        for old_line, line in enumerate(old_lines, 1):
+            if line.strip():
+                new_lines.append(line)
+                old_to_new[old_line] = len(new_lines)
+                new_to_old.append(old_line)
+        self.clear_comments_line_map = LineMap(old_to_new, new_to_old)
+        self.code_bytes = b'\n'.join(new_lines)
+    
+    # 对原始代码做一次修改：把 [start_byte, old_end_byte) 替换为 new_text，位置为原始代码（UTF-8）中的字节偏移
+    # 只重新清除修改附近的注释，拼接行号映射和清除注释后的代码，再用 Tree.edit 和旧语法树增量解析
+    # 保存 Node 的缓存（符号表、函数节点、按行查找的区间索引等）在下次使用时用新语法树重新建立
+    # 从 get_cmodule 得到的实例由 module_cache 共享，对应磁盘上的文件，不要直接修改
+    # 修改在实例的锁内执行，但其他线程此时仍在使用旧的 Node 时结果不确定，需要调用方自己避免
+    @locked
+    def update(self, start_byte:int, old_end_byte:int, new_text):
+        if isinstance(new_text, str):
+            new_text = new_text.encode('utf-8')
+        source = self.original_code_bytes
+        if self.literal_spans is None:
+            self.literal_spans = (array('q'), array('q'))
+            for match in COMMENT_OR_LITERAL_RE.finditer(source):
+                self.literal_spans[0].append(match.start())
+                self.literal_spans[1].append(match.end())
+            self.has_lone_cr = LONE_CR_RE.search(source) is not None
+        new_source = source[:start_byte] + new_text + source[old_end_byte:]
+        delta = len(new_text) - (old_end_byte - start_byte)
+        span_starts, span_ends = self.literal_spans
+        # 从修改所在行的行首开始重新扫描，行首在注释或字面量中（或紧接在它之后，修改可能把它延长）时退到它开始的那一行
+        # 上一行以 \ 续行时也退到上一行：那里没有闭合的引号可能因为这次修改变成跨行的字面量
+        restart = source.rfind(b'\n', 0, start_byte) + 1
+        while True:
+            i = bisect_left(span_starts, restart) - 1
+            if i >= 0 and span_ends[i] >= restart:
+                restart = source.rfind(b'\n', 0, span_starts[i]) + 1
+                continue
+            if restart > 0 and source[max(0, restart - 3):restart - 1].rstrip(b'\r').endswith(b'\\'):
+                restart = source.rfind(b'\n', 0, restart - 1) + 1
+                continue
+            break
+        # 修改之后扫描到一个与旧结果（平移 delta 后）相同的匹配时，后面的匹配都相同，
+        # 只需再扫描到这一行的行尾
+        new_spans = []
+        region_end = len(new_source)
+        synced = False
+        for match in COMMENT_OR_LITERAL_RE.finditer(new_source, restart):
+            s, e = match.span()
+            if synced:
+                if s >= region_end:
+                    break
+            elif s >= start_byte + len(new_text):
+                j = bisect_left(span_starts, s - delta)
+                if j < len(span_starts) and span_starts[j] == s - delta and span_ends[j] == e - delta:
+                    synced = True
+                    region_end = new_source.find(b'\n', s)
+                    if region_end < 0:
+                        region_end = len(new_source)
+            new_spans.append((s, e))
+        region = new_source[restart:region_end]
+        if self.has_lone_cr or LONE_CR_RE.search(region):
+            # 单独的 \r 也是换行（splitlines），行号无法按 \n 计算，整个重新处理
+            self.original_code_bytes = new_source
+            self.literal_spans = None
+            self.line_starts = None
+            self.clear_code(new_source)
+            self.tree = None
+            self.reset_node_caches()
+            return
+        # 修改附近重新清除注释，注释被截断在 region_end 处
+        pieces = []
+        pos = restart
+        for s, e in new_spans:
+            if s >= region_end:
+                break
+            e = min(e, region_end)
+            pieces.append(new_source[pos:s])
+            text = new_source[s:e]
+            # 字符串和字符字面量保持不变，注释只保留其中的换行
+            pieces.append(text if text[:1] in (b'"', b"'") else b'\n' * text.count(b'\n'))
+            pos = e
+        pieces.append(new_source[pos:region_end])
+        region_code = b''.join(pieces)
+        region_lines = region_code.split(b'\n')
+        # 清除注释后以换行结尾时，最后的空字符串不是一行（与 splitlines 相同）
+        if region_end == len(new_source) and (not region_code or region_code.endswith(b'\n')):
+            region_lines.pop()
+        # 修改范围内的旧行号为 [first_line, first_line + old_line_count)，新行号为 [k0, k1)
+        first_line = source.count(b'\n', 0, restart) + 1
+        line_map = self.clear_comments_line_map
+        old_to_new, new_to_old = line_map.old_to_new, line_map.new_to_old
+        if region_end - delta == len(source):
+            old_line_count = len(old_to_new) - first_line
+        else:
+            old_line_count = source.count(b'\n', restart, region_end - delta) + 1
+        k0 = bisect_left(new_to_old, first_line, 1)
+        k1 = bisect_left(new_to_old, first_line + old_line_count, 1)
+        kept_lines = []
+        region_old_to_new = array('i')
+        region_new_to_old = array('i')
+        for i, line in enumerate(region_lines):
+            if line.endswith(b'\r'):
+                line = line[:-1]
+            if line.strip():
+                kept_lines.append(line)
+                region_old_to_new.append(k0 + len(kept_lines) - 1)
+                region_new_to_old.append(first_line + i)
+            else:
+                region_old_to_new.append(0)
+        line_delta = len(region_lines) - old_line_count
+        kept_delta = len(kept_lines) - (k1 - k0)
+        tail = old_to_new[first_line + old_line_count:]
+        if kept_delta:
+            tail = array('i', [line + kept_delta if line else 0 for line in tail])
+        old_to_new = old_to_new[:first_line] + region_old_to_new + tail
+        tail = new_to_old[k1:]
+        if line_delta:
+            tail = array('i', [line + line_delta for line in tail])
+        new_to_old = new_to_old[:k0] + region_new_to_old + tail
+        self.clear_comments_line_map = LineMap(old_to_new, new_to_old)
+        # 拼接清除注释后的代码，每行都按以换行结尾处理
+        old_code = self.code_bytes
+        line_starts = self.line_starts
+        if line_starts is None:
+            line_starts = array('q', [0, 0])
+            pos = old_code.find(b'\n')
+            while pos >= 0:
+                line_starts.append(pos + 1)
+                pos = old_code.find(b'\n', pos + 1)
+            if not old_code:
+                line_starts.pop()
+        old_count = len(line_starts) - 1
+        ext = old_code + b'\n' if old_count else b''
+        code_start = line_starts[k0] if k0 <= old_count else len(ext)
+        code_end = line_starts[k1] if k1 <= old_count else len(ext)
+        replacement = b''.join(line + b'\n' for line in kept_lines)
+        new_ext = ext[:code_start] + replacement + ext[code_end:]
+        new_code = new_ext[:-1]
+        region_starts = array('q')
+        pos = code_start
+        for line in kept_lines:
+            region_starts.append(pos)
+            pos += len(line) + 1
+        byte_delta = len(replacement) - (code_end - code_start)
+        tail = line_starts[k1:]
+        if byte_delta:
+            tail = array('q', [start + byte_delta for start in tail])
+        new_line_starts = line_starts[:k0] + region_starts + tail
+        # 只把真正改变的字节告诉 tree-sitter
+        old_segment = ext[code_start:code_end]
+        prefix = len(os.path.commonprefix([old_segment, replacement]))
+        suffix = 0
+        limit = min(len(old_segment), len(replacement)) - prefix
+        while suffix < limit and old_segment[-1 - suffix] == replacement[-1 - suffix]:
+            suffix += 1
+        edit_start = min(code_start + prefix, len(old_code), len(new_code))
+        old_end = max(edit_start, min(code_end - suffix, len(old_code)))
+        new_end = max(edit_start, min(code_start + len(replacement) - suffix, len(new_code)))
+        def point(byte, starts):
+            line = bisect_right(starts, byte, 1) - 1
+            if line < 1:
+                return (0, byte)
+            return (line - 1, byte - starts[line])
+        self.tree.edit(
+            start_byte=edit_start,
+            old_end_byte=old_end,
+            new_end_byte=new_end,
+            start_point=point(edit_start, line_starts),
+            old_end_point=point(old_end, line_starts),
+            new_end_point=point(new_end, new_line_starts),
+        )
+        self.tree = get_parser().parse(new_code, self.tree)
+        self.code_bytes = new_code
+        self.line_starts = new_line_starts
+        self.original_code_bytes = new_source
+        # 注释和字面量的位置，修改之后的平移 delta
+        i = bisect_left(span_starts, restart)
+        j = bisect_left(span_starts, region_end - delta)
+        region_spans = [(s, e) for s, e in new_spans if s < region_end]
+        self.literal_spans = (
+            span_starts[:i] + array('q', [s for s, _ in region_spans]) + array('q', [s + delta for s in span_starts[j:]]),
+            span_ends[:i] + array('q', [e for _, e in region_spans]) + array('q', [e + delta for e in span_ends[j:]]),
+        )
+        self.reset_node_caches()
+
+    # 依次应用多个修改 [(start_byte, old_end_byte, new_text)]，每个修改的位置都基于前一个修改之后的代码
+    @locked
+    def apply_edits(self, edits):
+        for start_byte, old_end_byte, new_text in edits:
+            self.update(start_byte, old_end_byte, new_text)
+
     # 在项目目录中查找文件，对于系统库的情况，暂不考虑
+    # 项目目录只在第一次查找时遍历一次，之后都是在共享的 ProjectFileIndex 中按后缀查找
     def find_path_in_project(self, partial_path):
         # Examples：
         # onlplib/file.h
         # onlp/platformi/thermali.h
         # platform_lib.h
-        if partial_path in self.libs.keys():
-            return self.libs[partial_path]
-        for root, _, files in os.walk(self.project_dir):
-            for file in files:
-                # 计算文件的相对路径
-                path = os.path.join(root, file)
-                # 检查相对路径是否以指定的部分路径结尾
-                if path.endswith(partial_path):
-                    result = os.path.abspath(os.path.join(root, file))
-                    # 如果是头文件则存入缓存
-                    if result.endswith('.h'):
-                        self.libs[partial_path] = result
-                    return result
-        return ""
+        if not self.project_dir:
+            return ""
+        return get_project_file_index(self.project_dir).find(partial_path)
     
     # 获取当前文件所有头文件
+    # 还没有解析时直接在清除注释后的代码中扫描 #include，不建立语法树
     def get_all_headers(self):
-        res = []
-        # 前者匹配 "platform_lib.h"
-        # 后者匹配 <onlp/platformi/thermali.h>
-        query = C_LANGUAGE.query("""
-        (
-            (preproc_include
-                (string_literal) @header)
-            )
-            (
-            (preproc_include
-                (system_lib_string) @header_lib)
-            )
-        """)
-
-        captures = query.captures(self.root_node)
+        if self._tree is None:
+            return [match.group(1).decode() for match in INCLUDE_RE.finditer(self.code_bytes)]
+        captures = query_captures("headers", self.root_node)
         headers = []
-        for header_file, nodes in captures.items():
-            for node in nodes:
-                header_patial_path = node.text.decode()
-                headers.append(header_patial_path)
+        # 按在文件中出现的顺序
+        for node in sorted((node for nodes in captures.values() for node in nodes), key=lambda node: node.start_byte):
+            header_patial_path = node.text.decode()
+            headers.append(header_patial_path)
         return headers
     
     def get_header_path(self, header:str):
@@ -124,15 +1843,7 @@ class Cmodule():
         # <onlplib/file.h>
         # <onlp/platformi/thermali.h>
         # "platform_lib.h"
-        header_clean = header.strip('"<>')
-        if header_clean in self.libs.keys():
-            return self.libs[header_clean]
-        if header.endswith('"') and self.is_path:
-            parent_dir = os.path.dirname(self.path)
-            abs_path = os.path.join(parent_dir, header_clean)
-            if os.path.exists(abs_path):
-                return abs_path
-        return self.find_path_in_project(header_clean)
+        return resolve_header_path(header, self.path if self.is_path else "", self.project_dir)
     
     def is_macro_definition(self, s):
         if not s:
@@ -140,22 +1851,76 @@ class Cmodule():
         # 判断字符串是否全为大写字母或下划线
         return s.isupper() and all(c.isupper() or c == '_' for c in s)
     
+    # 符号表：一次匹配得到本文件的全部定义，按名字索引，之后的 get_* 都是字典查找
+    # {
+    #     "macro": {name: [preproc_def / preproc_function_def]},
+    #     "function": {name: [function_definition]},
+    #     "function_declaration": {name: [declaration]},
+    #     "type": {name: [struct/union 定义 或 type_definition]},
+    #     "enum": [enum_specifier], 包括匿名 enum
+    #     "enumerator": {name: [enum_specifier]},
+    #     "extern_var": {name: [declaration]},
+    #     "global_var": {name: [declaration]}, 文件作用域中的非函数声明
+    # }
+    def get_symbols(self) -> dict:
+        if self.symbols is None:
+            with self.lock:
+                if self.symbols is None:
+                    self.build_symbols()
+        return self.symbols
+
+    # 建好全部结果后再赋值，其他线程看到 symbols 不为 None 时，函数节点列表也已经是完整的
+    def build_symbols(self):
+        symbols = {
+            "macro": {},
+            "function": {},
+            "function_declaration": {},
+            "type": {},
+            "enum": [],
+            "enumerator": {},
+            "extern_var": {},
+            "global_var": {},
+        }
+        def add(kind, name_node, node):
+            symbols[kind].setdefault(name_node.text.decode(), []).append(node)
+        captures = query_captures("symbols", self.root_node)
+        for node in captures.get("macro_def", []):
+            add("macro", node, node.parent)
+        for node in captures.get("type_identifier", []):
+            add("type", node, node.parent)
+        for node in captures.get("enum_name", []):
+            add("enumerator", node, node.parent.parent.parent)
+        for node in captures.get("identifier", []):
+            add("extern_var", node, node.parent)
+        symbols["enum"] = [node.parent for node in captures.get("enumerator_list", [])]
+        all_function_nodes = captures.get("function", [])
+        # 返回指针的函数的 function_declarator 不直接在 function_definition 之下，按声明符链找名字
+        for node in all_function_nodes:
+            name_node = get_declarator_identifier(node.child_by_field_name('declarator'))
+            if name_node is not None:
+                add("function", name_node, node)
+        all_function_declaration_nodes = [node.parent for node in captures.get("function_declarator", [])]
+        for node in all_function_declaration_nodes:
+            name_node = node.child_by_field_name('declarator').child_by_field_name('declarator')
+            if name_node:
+                add("function_declaration", name_node, node)
+        # 文件作用域的变量声明，只需要看根节点和条件编译块的子节点
+        function_declaration_nodes = set(all_function_declaration_nodes)
+        def add_global_vars(parent):
+            for node in parent.named_children:
+                if node.type in ['preproc_if', 'preproc_ifdef', 'preproc_else', 'preproc_elif']:
+                    add_global_vars(node)
+                elif node.type == 'declaration' and node not in function_declaration_nodes:
+                    for n in query_captures("declarator_ids", node).get("id", []):
+                        add("global_var", n, node)
+        add_global_vars(self.root_node)
+        self.all_function_nodes = all_function_nodes
+        self.all_function_declaration_nodes = all_function_declaration_nodes
+        self.symbols = symbols
+
     # 获得当前文件所有的宏定义
     def get_all_preproc_defs(self) -> dict[str:Node]:
-        query = C_LANGUAGE.query(f"""
-        (preproc_def
-            name: (identifier) @macro_def
-        ) 
-        (preproc_function_def
-            name: (identifier) @macro_def
-        ) 
-        """)
-        captures = query.captures(self.root_node)
-        res = {}
-        for _, nodes in captures:
-            for node in nodes:
-                res[node.text.decode()] = node.parent
-        return res
+        return {name: nodes[-1] for name, nodes in self.get_symbols()["macro"].items()}
     
     
     def get_preproc_def_text(self,identifier:str):
@@ -164,104 +1929,91 @@ class Cmodule():
     
     # 获取当前文件指定宏定义
     def get_preproc_def(self,identifier:str) -> list[Node]:
-        query = C_LANGUAGE.query(f"""
-        (preproc_def 
-            name: (identifier) @macro_name 
-            (#eq? @macro_name "{identifier}")
-        ) @macro_def
-        (preproc_function_def
-            name: (identifier) @macro_name 
-            (#eq? @macro_name "{identifier}")
-        ) @macro_def
-        """)
-        captures = query.captures(self.root_node)
-        results = []
-        for node in captures["macro_def"]:
-            results.append(node)
-        
+        results = self.get_symbols()["macro"].get(identifier, [])
         if results:
             return results
         # 本文件中找不到宏定义，获取所有头文件
         # 只有input为路径才能跨文件找
         if self.is_path:
-            Cross_file_res = self.dosomething_in_headers('get_preproc_def', identifier)
+            Cross_file_res = self.find_in_symbol_index('get_preproc_def', 'macro', identifier)
+            if Cross_file_res is None:
+                Cross_file_res = self.dosomething_in_headers('get_preproc_def', identifier)
             if Cross_file_res:
                 return Cross_file_res
         # 都没找到
         return []
     
     def get_preproc_def_include_line_index(self, new_line_index: int):
-        query = C_LANGUAGE.query(f"""
-        (preproc_def
-            name: (identifier) @macro_def
-        ) 
-        (preproc_function_def
-            name: (identifier) @macro_def
-        ) 
-        """)
-        captures = query.captures(self.root_node)
-        all_preproc_def_nodes = [node.parent for node in captures["macro_def"]]
-        
-        # 遍历节点，找到包含指定行号的节点
-        for preproc_def_node in all_preproc_def_nodes:
-            if preproc_def_node.start_point[0] <= new_line_index and new_line_index < preproc_def_node.end_point[0]:
-                return preproc_def_node
-        
-        return None
+        intervals = self.line_intervals.get("macro")
+        if intervals is None:
+            all_preproc_def_nodes = [node for nodes in self.get_symbols()["macro"].values() for node in nodes]
+            intervals = self.line_intervals["macro"] = LineIntervals(all_preproc_def_nodes)
+        # 宏定义节点的结束位置在下一行的行首，所以不包含结束行
+        return intervals.find(new_line_index, include_end=False)
     
     def get_enum_def(self, identifier:str):
-        query = C_LANGUAGE.query(f"""        
-        (enum_specifier
-            (enumerator_list
-                (enumerator
-                    name: (identifier) @enum_name
-                    (#eq? @enum_name "{identifier}")
-                )
-            )
-        )""")
-        captures = query.captures(self.root_node)
-        results = []
-        for node in captures["enum_name"]:
-            results.append(node.parent.parent.parent)
+        results = self.get_symbols()["enumerator"].get(identifier, [])
         if results:
             return results
         # 本文件中找不到，获取所有头文件
         # 只有input为路径才能跨文件找
         if self.is_path:
-            Cross_file_res = self.dosomething_in_headers('get_enum_def', identifier)
+            Cross_file_res = self.find_in_symbol_index('get_enum_def', 'enumerator', identifier)
+            if Cross_file_res is None:
+                Cross_file_res = self.dosomething_in_headers('get_enum_def', identifier)
             if Cross_file_res:
                 return Cross_file_res
         # 都没找到
         return []
     
+    # 在项目的持久化符号索引中找符号所在的头文件，再在该头文件上执行指定函数
+    # 项目没有打开索引时返回 None，调用方需要退回到 dosomething_in_headers
+    def find_in_symbol_index(self, func_name, kind:str, identifier:str):
+        index = get_project_symbol_index(self.project_dir)
+        if index is None or not self.path or depth_tracker.value:
+            return None
+        index.update_file(self.path, module=self)
+        header_path = index.find_definition_file(self.path, kind, identifier, MAX_DEPTH)
+        if not header_path:
+            return []
+        if instrumentation is not None:
+            instrumentation.record_hop(None)
+        header_module = get_cmodule(header_path, self.project_dir)
+        depth_tracker.value = 1
+        try:
+            return getattr(header_module, func_name)(identifier)
+        finally:
+            depth_tracker.value = 0
+
     # 跨文件执行指定函数
+    # 按 IncludeGraph 算出的搜索顺序依次在头文件上执行，头文件上的方法不再自己跨文件
     def dosomething_in_headers(self, func_name, *args, **kwargs):
-        if depth_tracker.value >= MAX_DEPTH:
+        if not self.is_path or depth_tracker.value:
             return None
-        if self.is_path:
-            headers = self.get_all_headers()
-            # 得到所有头文件路径
-            header_paths = [self.get_header_path(header) for header in headers]
-            for header_path in header_paths:
-                # 在头文件中查找
-                if not header_path:
+        include_graph = get_include_graph(self.project_dir)
+        header_paths = include_graph.get_search_order(self.path, MAX_DEPTH)
+        depths = include_graph.get_search_depths(self.path, MAX_DEPTH) if instrumentation is not None else None
+        # 头文件中根本没有这个 identifier 时跳过，不解析
+        identifier = args[0] if func_name in PREFILTER_METHODS and args and isinstance(args[0], str) else None
+        depth_tracker.value = 1
+        try:
+            for i, header_path in enumerate(header_paths):
+                if identifier is not None and not identifier_filter.may_contain(header_path, identifier, self.project_dir):
                     continue
-                depth_tracker.value += 1
-                header_module = Cmodule(header_path, self.project_dir)
+                if depths is not None:
+                    instrumentation.record_hop(depths[i])
+                # 在头文件中查找
+                header_module = get_cmodule(header_path, self.project_dir)
                 # 获取新实例上的同名方法
                 method_to_call = getattr(header_module, func_name, None)
                 if method_to_call is None or not callable(method_to_call):
                     raise AttributeError(f"方法 '{func_name}' 不存在或不可调用")
                 Cross_file_res = method_to_call(*args, **kwargs)
-                
-                # 缓存
-                ###################
-                
                 # 如果该头文件中找到了，就返回
                 if Cross_file_res:
-                    depth_tracker.value -= 1
-                    return Cross_file_res 
-        depth_tracker.value -= 1
+                    return Cross_file_res
+        finally:
+            depth_tracker.value = 0
         return None
     
     # # 获取指定节点的identifier，通常是name
@@ -274,31 +2026,24 @@ class Cmodule():
 
     # new_line = self.clear_comments_line_map[old_line]
     def get_function_include_line_index(self, new_line_index:int):
-        all_functions_nodes = self.get_all_function_nodes()
-        for function_node in all_functions_nodes:
-            if function_node.start_point[0] <= new_line_index <= function_node.end_point[0]:
-                return function_node
-        return None
+        intervals = self.line_intervals.get("function")
+        if intervals is None:
+            intervals = self.line_intervals["function"] = LineIntervals(self.get_all_function_nodes())
+        return intervals.find(new_line_index)
+
+    # node 的 named_children 中包含指定行（从0开始）的第一个节点
+    def get_child_in_line(self, node:Node, new_line_index:int):
+        intervals = self.line_intervals.get(node.id)
+        if intervals is None:
+            intervals = self.line_intervals[node.id] = LineIntervals(node.named_children)
+        return intervals.find(new_line_index)
     
     def get_all_function_nodes(self) -> list[Node]:
-        if self.all_function_nodes:
-            return self.all_function_nodes
-        query = C_LANGUAGE.query(f"""(function_definition)@function""")
-        captures = query.captures(self.root_node)
-        self.all_function_nodes = captures["function"]
+        self.get_symbols()
         return self.all_function_nodes
             
     def get_all_function_declaration_nodes(self) -> list[Node]:
-        if self.all_function_declaration_nodes:
-            return self.all_function_declaration_nodes
-        query = C_LANGUAGE.query(f"""
-        (declaration
-            declarator: (function_declarator) @function_declarator
-        )
-        """)
-        captures = query.captures(self.root_node)
-        for node in captures["function_declarator"]:
-            self.all_function_declaration_nodes.append(node.parent)
+        self.get_symbols()
         return self.all_function_declaration_nodes
     
     def get_function_names(self, function_nodes:list[Node]) -> list[str]:
@@ -315,16 +2060,9 @@ class Cmodule():
         
     
     def get_function_node(self, function_id):
-        query = C_LANGUAGE.query(f"""
-        (function_definition
-            (function_declarator 
-                (identifier) @function_id 
-                (#eq? @function_id "{function_id}")
-            )
-        )""")
-        captures = query.captures(self.root_node)
-        if captures:
-            return captures["function_id"][0].parent.parent
+        function_nodes = self.get_symbols()["function"].get(function_id)
+        if function_nodes:
+            return function_nodes[0]
         preproc_def_nodes =  self.get_preproc_def(function_id)
         if preproc_def_nodes:
             for preproc_def_node in preproc_def_nodes:
@@ -336,19 +2074,12 @@ class Cmodule():
         function_node = self.get_function_node(function_id)
         if not function_node:
             return None
-        query = C_LANGUAGE.query("""
-        (function_definition
-            (storage_class_specifier)* @storage_class_specifier
-            type:(_) @ret
-            declarator:(function_declarator) @function_declarator
-        )
-        """)
         res = {
             "storage_class_specifier":[],
             "ret" : "",
             "function_declarator" : ""
         }
-        for capture, nodes in query.captures(function_node).items():
+        for capture, nodes in query_captures("function_signature", function_node).items():
             if capture == "storage_class_specifier":
                 res[capture].extend([node.text.decode() for node in nodes])
             else:
@@ -364,24 +2095,16 @@ class Cmodule():
         if not target_node:
             return None
         # 再在node中查询call_expression
-        query = C_LANGUAGE.query(f"""
-        (call_expression
-            function: (identifier)@identifier
-        )""")
         res = []
-        captures = query.captures(target_node)
-        for node in captures["identifier"]:
+        captures = query_captures("call_identifiers", target_node)
+        for node in captures.get("identifier", []):
             res.append(node.text.decode())
         return res
     
     def get_all_call_functions(self) -> list[Node]:
-        query = C_LANGUAGE.query(f"""
-        (call_expression
-            function: (identifier)@identifier
-        )""")
         call_functions = []
-        captures = query.captures(self.root_node)
-        for node in captures["identifier"]:
+        captures = query_captures("call_identifiers", self.root_node)
+        for node in captures.get("identifier", []):
             call_functions.append(node)
         return call_functions
     
@@ -394,152 +2117,182 @@ class Cmodule():
     #     return external_functions
     
     def get_typedef_ids_from_node(self, node:Node) -> list[str]:
-        query = C_LANGUAGE.query(f"""(type_identifier) @type_identifier""")
-        type_ids = []
-        for node in query.captures(node)["type_identifier"]:
-            type_ids.append(node.text.decode())
-        return type_ids
+        if not self.owns_node(node):
+            return [n.text.decode() for n in query_captures("type_identifiers", node).get("type_identifier", [])]
+        return self.get_occurrence_index().names_in_range(node.start_byte, node.end_byte, 1)
+
+    # 全部 identifier 和 type_identifier 的出现位置，第一次使用时建立，语法树改变后重新建立
+    def get_occurrence_index(self) -> OccurrenceIndex:
+        if self.occurrence_index is None:
+            self.occurrence_index = OccurrenceIndex(self.root_node)
+        return self.occurrence_index
+
+    # node 是否是本文件当前语法树中的节点，其他文件（如头文件）或旧语法树中的节点不能用本文件的出现位置索引
+    # 按字节范围找到最小的节点再向上找同样范围的节点，节点相等时树也相同
+    def owns_node(self, node:Node) -> bool:
+        candidate = self.root_node.descendant_for_byte_range(node.start_byte, node.end_byte)
+        while candidate is not None and candidate.start_byte == node.start_byte and candidate.end_byte == node.end_byte:
+            if candidate == node:
+                return True
+            candidate = candidate.parent
+        return False
+
+    # 本文件中名字的全部出现 [(名字, 种类, start_byte, end_byte, 行, 列, 父节点类型)]，行列号从0开始
+    # kind 为 "identifier" 或 "type_identifier"，为空时都包括
+    def find_references(self, name:str, kind:str = "") -> list[tuple]:
+        return self.get_occurrence_index().find(name, kind)
+
+    # 本文件中使用宏的位置（包括 #ifdef 等条件中），不包括宏定义本身和宏参数
+    def find_macro_uses(self, name:str) -> list[tuple]:
+        return [occurrence for occurrence in self.find_references(name, "identifier")
+            if occurrence[6] not in ('preproc_def', 'preproc_function_def', 'preproc_params')]
+
+    # 第 start_line 到 end_line 行（清除注释后，从1开始，包括两端）中出现的类型名，按第一次出现的顺序去重
+    def get_types_used_in_range(self, start_line:int, end_line:int) -> list[str]:
+        index = self.get_occurrence_index()
+        start_byte, end_byte = index.row_range(start_line - 1, end_line - 1)
+        return list(dict.fromkeys(index.names_in_range(start_byte, end_byte, 1)))
     
-    def check_header_used(self, header:str):
-        if not self.is_path or not self.project_dir or not header:
-            raise AssertionError("没有文件或项目路径信息，无法获得外部函数")
-        path = self.get_header_path(header) 
-        if not path:
-            # 没有找到路径，可能是标准库，也有可能不在项目中
-            return f"没有在项目中找到头文件{header}, 可能是标准库"
-        header_module = Cmodule(input=path,project_dir=self.project_dir)
+    # 数据类型定义节点的类型名，匿名的 enum 返回 None
+    def get_struct_node_name(self, node:Node):
+        if node.type == 'type_definition':
+            return node.child_by_field_name('declarator').text.decode()
+        name = node.child_by_field_name('name')
+        if name:
+            return name.text.decode()
+        return None
+
+    # 当前文件用到的、需要由头文件提供的符号，只计算一次
+    # {
+    #     "function": 调用的函数名,
+    #     "type": 用到的类型名（删去本文件中定义的类型）,
+    #     "macro": 直接使用的宏（删去本文件中定义的宏）,
+    #     "extern_var": extern 全局变量 "变量名@@@类型",
+    # }
+    def get_usage_sets(self) -> dict:
+        if self.usage_sets is not None:
+            return self.usage_sets
         ################################################################################
         # 函数
         ## 当前文件的调用函数
         call_func_nodes = self.get_all_call_functions()
         call_func_names = set([node.text.decode() for node in call_func_nodes if node])
-        if call_func_names:
-            ## header中的函数定义和函数声明
-            header_func_nodes = header_module.get_all_function_nodes() \
-                + header_module.get_all_function_declaration_nodes()
-            # 去重
-            header_func_nodes = list(set(header_func_nodes))
-            header_func_names = set(header_module.get_function_names(header_func_nodes))
-            intersection_funcs = header_func_names.intersection(call_func_names)
-            if intersection_funcs:
-                # res = {}
-                # for func_name in intersection_funcs:
-                #     res[func_name] = header_module.get_function_node(func_name)
-                # return res
-                return True
         ################################################################################
         # 数据类型
         ## 当前文件的数据类型, 需要删去本文件中有的的定义的类型
         type_ids = set(self.get_typedef_ids_from_node(self.root_node))
-        type_def_nodes = self.get_all_struct_nodes()
-        type_def_ids = set()
-        for node in type_def_nodes:
-            if node.type == 'type_definition':
-                id = node.child_by_field_name('declarator').text.decode()
-            elif node.type == 'enum_specifier':
-                type_id = node.child_by_field_name('name')
-                if type_id:
-                    id = type_id.text.decode()
-                else:
-                    continue
-                    # type_id = "anonymous_enum"
-            else:
-                id = node.child_by_field_name('name').text.decode()
-            type_def_ids.add(id)
+        type_def_ids = set(self.get_struct_node_name(node) for node in self.get_all_struct_nodes())
         type_ids = type_ids - type_def_ids
-        if type_ids:
-            ## header中对应的声明和定义
-            header_typedef_nodes = header_module.get_all_struct_nodes()
-            header_typedef_dict = {}
-            for node in header_typedef_nodes:
-                if node.type == 'type_definition':
-                    id = node.child_by_field_name('declarator').text.decode()
-                else:
-                    id = node.child_by_field_name('name').text.decode()
-                header_typedef_dict[id] = node
-            header_typedef_ids = set(header_typedef_dict.keys())
-            intersection_type_ids = header_typedef_ids.intersection(type_ids)
-            if intersection_type_ids:
-                # return {type_id : header_typedef_dict[type_id] for type_id in intersection_type_ids}
-                return True
         ################################################################################
         # 宏
-        ## 当前文件直接使用的宏
+        ## 当前文件直接使用的宏，删去当前文件定义的宏
         macro_defs = self.get_all_preproc_def_ids_in_node(self.root_node)
-        ## 当前文件定义的宏删去
-        macro_defs_defined = self.get_all_preproc_defs()
-        macro_defs_defined_set = set(macro_defs_defined.keys())
-        # 删去
-        macro_defs_set = set(macro_defs) - macro_defs_defined_set
-        if macro_defs_set:
-            ## header中对应的定义
-            header_macro_defs_defined_dict = header_module.get_all_preproc_defs()
-            header_macro_defs_defined_set = set(header_macro_defs_defined_dict.keys())
-            intersection_macro_defs = header_macro_defs_defined_set.intersection(macro_defs_set)
-            if intersection_macro_defs:
-                # return {macro_def : header_macro_defs_defined_dict[macro_def] for macro_def in intersection_macro_defs}
-                return True
+        macro_defs_set = set(macro_defs) - set(self.get_all_preproc_defs().keys())
         ################################################################################
         # 变量
         ## 当前文件的extern全局变量
         extern_vars_dict = self.get_all_extern_gloabal_vars()
-        var_type_set = set([f"{var}@@@{type_v}" for var, (type_v, _) in extern_vars_dict.items()])
-        if var_type_set:
-            ## header中对应的声明和定义
-            header_global_vars_dict = header_module.get_all_global_vars_init_and_declaration()
-            header_var_type_set = set([f"{var}@@@{type_v}" for var, (type_v, _) in header_global_vars_dict.items()])
-            intersection_var_type = header_var_type_set.intersection(var_type_set)
-            if intersection_var_type:
-                # return { var_type.split('@@@')[0] : header_global_vars_dict[var_type.split('@@@')[0]][1] for var_type in intersection_var_type}
-                return True
-        return False
+        # get_all_extern_gloabal_vars 返回类型节点，与 get_header_exports 一样用类型的文本
+        var_type_set = set([f"{var}@@@{type_v.text.decode()}" for var, (type_v, _) in extern_vars_dict.items()])
+        self.usage_sets = {
+            "function": call_func_names,
+            "type": type_ids,
+            "macro": macro_defs_set,
+            "extern_var": var_type_set,
+        }
+        return self.usage_sets
+
+    # 当前文件（作为头文件）提供的符号，键与 get_usage_sets 相同，只计算一次
+    # 头文件的 Cmodule 在 module_cache 中复用，所以多个源文件检查同一个头文件时也只计算一次
+    def get_header_exports(self) -> dict:
+        if self.header_exports is not None:
+            return self.header_exports
+        ## header中的函数定义和函数声明
+        header_func_nodes = self.get_all_function_nodes() \
+            + self.get_all_function_declaration_nodes()
+        # 去重
+        header_func_nodes = list(set(header_func_nodes))
+        header_typedef_ids = set(self.get_struct_node_name(node) for node in self.get_all_struct_nodes())
+        header_typedef_ids.discard(None)
+        header_global_vars_dict = self.get_all_global_vars_init_and_declaration()
+        self.header_exports = {
+            "function": set(self.get_function_names(header_func_nodes)),
+            "type": header_typedef_ids,
+            "macro": set(self.get_all_preproc_defs().keys()),
+            "extern_var": set([f"{var}@@@{type_v}" for var, (type_v, _) in header_global_vars_dict.items()]),
+        }
+        return self.header_exports
+
+    # 头文件提供的、当前文件用到的符号，键与 get_usage_sets 相同
+    def get_header_provided(self, header_exports:dict) -> dict:
+        usage_sets = self.get_usage_sets()
+        return {kind: usage_sets[kind].intersection(header_exports[kind]) for kind in usage_sets}
+
+    def check_header_used(self, header:str):
+        if not self.is_path or not self.project_dir or not header:
+            raise AssertionError("没有文件或项目路径信息，无法获得外部函数")
+        path = self.get_header_path(header) 
+        if not path:
+            # 没有找到路径，可能是标准库，也有可能不在项目中
+            return f"没有在项目中找到头文件{header}, 可能是标准库"
+        header_module = get_cmodule(path, self.project_dir)
+        provided = self.get_header_provided(header_module.get_header_exports())
+        return any(provided.values())
+
+    # 一次检查多个头文件（默认为本文件 include 的全部头文件）是否被使用
+    # 当前文件的使用情况只计算一次，头文件提供的符号通过 module_cache 复用
+    # workers 大于 1 时用进程池并行解析头文件
+    # 返回 {header: 结果}，结果为 None 表示没有在项目中找到头文件，否则为
+    # {"path": 头文件路径, "used": 是否被使用, "function"/"type"/"macro"/"extern_var": 头文件提供的、当前文件用到的符号}
+    def which_headers_are_used(self, headers:list[str] = None, workers:int = 0) -> dict:
+        if not self.is_path or not self.project_dir:
+            raise AssertionError("没有文件或项目路径信息，无法获得外部函数")
+        if headers is None:
+            headers = self.get_all_headers()
+        paths = {header: self.get_header_path(header) for header in headers}
+        unique_paths = list(dict.fromkeys(path for path in paths.values() if path))
+        if workers > 1 and len(unique_paths) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                exports = dict(zip(unique_paths, executor.map(get_header_exports_from_file,
+                    unique_paths, [self.project_dir] * len(unique_paths))))
+        else:
+            exports = {path: get_cmodule(path, self.project_dir).get_header_exports() for path in unique_paths}
+        res = {}
+        for header, path in paths.items():
+            if not path:
+                # 没有找到路径，可能是标准库，也有可能不在项目中
+                res[header] = None
+                continue
+            provided = self.get_header_provided(exports[path])
+            res[header] = {"path": path, "used": any(provided.values())}
+            res[header].update({kind: sorted(names) for kind, names in provided.items()})
+        return res
     
     def get_all_preproc_def_ids_in_node(self, n:Node) -> list[str]:
-        query = C_LANGUAGE.query(f"""
-        ((identifier) @macro_def
-        (#match? @macro_def "^[A-Z_]+$")
-        )""")
-        captures = query.captures(n)
-        return [node.text.decode()
-            for node in captures["macro_def"] if node]
+        if not self.owns_node(n):
+            return [node.text.decode() for node in query_captures("macro_ids", n).get("macro_def", [])]
+        index = self.get_occurrence_index()
+        return index.names_in_range(n.start_byte, n.end_byte, 0, name_ids=index.macro_name_ids)
     
     
     def get_all_extern_gloabal_vars(self):
-        query = C_LANGUAGE.query(f"""
-        (declaration
-            (storage_class_specifier) @storage_class_specifier
-            (#eq? @storage_class_specifier "extern")
-            type:(_)
-            declarator: (identifier) @identifier
-        )""")
-        captures = query.captures(self.root_node)
-        return { node.text.decode() : (node.parent.child_by_field_name('type'), node.parent)
-            for node in captures["identifier"]}
+        return { name : (nodes[-1].child_by_field_name('type'), nodes[-1])
+            for name, nodes in self.get_symbols()["extern_var"].items()}
         
     def get_all_global_vars_init_and_declaration(self):
-        query = C_LANGUAGE.query(f"""
-        (declaration
-            type:(_)
-            declarator: (identifier)@decl
-        )
-        (declaration
-            type:(_)
-            (init_declarator) @init
-        )""")
         temp_nodes = []
-        captures = query.captures(self.root_node)
-        for node in captures["decl"]:
+        captures = query_captures("global_vars", self.root_node)
+        for node in captures.get("decl", []):
             temp = node.parent
             tt = temp.child_by_field_name('storage_class_specifier')
             if tt and tt.text.decode() == 'extern':
                 continue
             temp_nodes.append(temp)
-        for node, capture in captures["init"]:
-            temp_nodes.append
-        q = C_LANGUAGE.query(f"""declarator: ((identifier) @id)""")
+        for node in captures.get("init", []):
+            temp_nodes.append(node.parent)
         res = {}
         for node in temp_nodes:
-            for n in q.captures(node)["id"]:
+            for n in query_captures("declarator_ids", node).get("id", []):
                 temp = n
                 while(temp.type != 'declaration' and temp != self.root_node):
                     temp = temp.parent
@@ -558,23 +2311,19 @@ class Cmodule():
         while(temp):
             # flag：标志这个for循环中，temp有没有往下深入一层
             flag = False
-            for node in temp.named_children:
-                start = node.start_point[0]
-                end = node.end_point[0]
-                if start <= new_line_index <= end:
-                    flag = True
-                    if start == end:
-                        # 如果是以下几种情况，可能需要获得父节点
-                        if node.parent.type in [
-                            'preproc_def',
-                            'preproc_function_def',
-                            'call_expression',
-                        ]:
-                            return node.parent
-                        return node
-                    last_temp == temp
-                    temp = node
-                    break
+            node = self.get_child_in_line(temp, new_line_index)
+            if node:
+                flag = True
+                if node.start_point[0] == node.end_point[0]:
+                    # 如果是以下几种情况，可能需要获得父节点
+                    if node.parent.type in [
+                        'preproc_def',
+                        'preproc_function_def',
+                        'call_expression',
+                    ]:
+                        return node.parent
+                    return node
+                temp = node
             # 如果该行本来被被包括在一个node中
             # 但是这个node的named children中都没有
             # 说明不是这个node的named children，例如 };，);这种
@@ -603,20 +2352,9 @@ class Cmodule():
         if target_node.type == 'function_definition' and \
             target_node.end_point[0] + 1 == new_line_number:
             return []
-        # 再在node中查询identifier
-        query = C_LANGUAGE.query(f"""(identifier)@id""")
-        res = []
-        captures = query.captures(target_node)
-        for node in captures["id"]:
-            if node.parent.type in [
-                'call_expression',
-                'enumerator',
-                'preproc_def',
-                'preproc_function_def'
-            ]:
-                continue
-            res.append(node.text.decode())
-        return res
+        # 再在node中查找identifier
+        index = self.get_occurrence_index()
+        return index.names_in_range(target_node.start_byte, target_node.end_byte, 0, index.var_excluded_parents)
     
     # 在已知func_node之中找变量identifier的定义
     # 得到初始化或者声明
@@ -627,95 +2365,12 @@ class Cmodule():
     def get_local_var_def(self, func_node:Node, identifier:str):
         # # 获取函数node
         # func_node = self.get_function_node(func_id)
-        qs = []
-        # 1. 仅声明
-        qs.append(f"""
-        (declaration
-            declarator: (identifier) @decl_id
-            (#eq? @decl_id "{identifier}")
-        )""")
-        ## 指针类型
-        qs.append(f"""
-        (declaration
-            (pointer_declarator
-                declarator: (identifier) @decl_pointer_id
-                (#eq? @decl_pointer_id "{identifier}")
-            )
-        )""")
-        # 2. 初始化变量
-        qs.append(f"""
-        (declaration
-            (init_declarator
-                declarator: (identifier) @decl_init_id
-                (#eq? @decl_init_id "{identifier}")
-            )
-        )""")
-        ## 指针类型
-        qs.append(f"""
-        (declaration
-            (init_declarator
-                (pointer_declarator
-                    declarator: (identifier) @decl_init_pointer_id
-                    (#eq? @decl_init_pointer_id "{identifier}")
-                )
-            )
-        )""")
-        # 3. 参数内变量
-        qs.append(f"""
-        (parameter_declaration
-            declarator: (identifier) @param_id
-            (#eq? @param_id "{identifier}")
-        )""")
-        # 指针类型
-        qs.append(f"""
-        (parameter_declaration
-            (pointer_declarator
-                declarator: (identifier) @param_pointer_id
-                (#eq? @param_pointer_id "{identifier}")
-            )
-        )""")
-        # 5. 特殊类型，如 数组 等以多个部分(且不并列)组成的
-        qs.append(f"""
-        (declaration
-            (array_declarator
-                declarator: (identifier) @decl_array_id
-                (#eq? @decl_array_id "{identifier}")
-            )
-        )
-        (declaration
-            (init_declarator
-                (array_declarator
-                    declarator: (identifier) @decl_init_array_id
-                    (#eq? @decl_init_array_id "{identifier}")
-                )
-            )
-        )""")
-        ## 指针类型
-        qs.append(f"""
-        (declaration
-            (pointer_declarator
-                (array_declarator
-                    declarator: (identifier) @decl_pointer_array_id
-                    (#eq? @decl_pointer_array_id "{identifier}")
-                )
-            )
-        )
-        (declaration
-            (init_declarator
-                (pointer_declarator
-                    (array_declarator
-                        declarator: (identifier) @decl_init_pointer_array_id
-                        (#eq? @decl_init_pointer_array_id "{identifier}")
-                    )
-                )
-            )
-        )""")
-        query = C_LANGUAGE.query('\n'.join(qs))
-        captures = query.captures(func_node)
+        # 1. 仅声明 2. 初始化变量 3. 参数内变量 以及对应的指针、数组类型，见 QUERIES["local_vars"]
+        captures = filter_captures(query_captures("local_vars", func_node), identifier)
         # 如果当前func_node中没找到（通常func_node认为是函数）
         # 则在全局中找
         if not captures:
-            captures = query.captures(self.root_node)
+            captures = filter_captures(query_captures("local_vars", self.root_node), identifier)
         res = []
         for capture_name, nodes in captures.items():
             for node in nodes:
@@ -767,26 +2422,11 @@ class Cmodule():
         # 3. 参数内变量
         # 4. 指针类型
         # 5. 特殊类型，如 数组 等以多个部分(且不并列)组成的
-        query1 = C_LANGUAGE.query(f"""
-        (declaration
-            type:(_)
-            declarator: (_) @declarator
-        )
-        (parameter_declaration
-            type:(_)
-            declarator: (_) @declarator
-        )
-        """)
-        init_and_declaration_nodes = [node.parent for node in query1.captures(node)["declarator"]] 
-        query2 = C_LANGUAGE.query(f"""
-        declarator: (
-            (identifier) @id
-            (#eq? @id "{identifier}")
-        )
-        """)
+        init_and_declaration_nodes = [node.parent for node in query_captures("var_declarators", node).get("declarator", [])]
         res_nodes = []
         for init_and_declaration_node in init_and_declaration_nodes:
-            if "id" in query2.captures(init_and_declaration_node).keys():
+            captures = filter_captures(query_captures("declarator_ids", init_and_declaration_node), identifier)
+            if "id" in captures.keys():
                 res_nodes.append(init_and_declaration_node)
         return res_nodes
     
@@ -801,63 +2441,136 @@ class Cmodule():
         # 则在全局中找
         if not var_init_and_declaration_nodes:
             var_init_and_declaration_nodes = self.get_var_init_and_declaration_nodes_from_node(self.root_node, identifier)
+        res = [text for _, text in self.get_var_def_parts(var_init_and_declaration_nodes)]
+        if not res:
+            preproc_defs:list[Node] = self.get_preproc_def(identifier)
+            res = [f'{preproc_def.text.decode()}' for preproc_def in preproc_defs]
+        if res:
+            return res
+        return []
+
+    # 变量类型的名字，用于 get_struct_def，常规类型返回 None
+    def get_var_type_id(self, node:Node):
+        var_type_node = node.child_by_field_name('type')
+        type_type = var_type_node.type
+        # typedef
+        if type_type == 'type_identifier':
+            return var_type_node.text.decode()
+        # struct, enum, union之类的
+        if type_type in [
+            'struct_specifier',
+            'union_specifier',
+            'enum_specifier',
+        ]:
+            type_id = var_type_node.child_by_field_name('name')
+            if type_id:
+                return type_id.text.decode()
+            return f"anonymous_{type_type}"
+        return None
+
+    # 声明节点的文本和类型定义的文本 [("declaration" 或 "type", 文本)]，顺序与 get_local_var_def_new 的结果相同
+    # type_defs 为 type_id -> 类型定义文本 的缓存，批量查找时多个变量共用
+    def get_var_def_parts(self, var_init_and_declaration_nodes:list[Node], type_defs:dict = None) -> list[tuple]:
+        if type_defs is None:
+            type_defs = {}
         res = []
         for node in var_init_and_declaration_nodes:
             # node中第一次出现
-            res.append(f'{node.text.decode()}')
+            res.append(("declaration", f'{node.text.decode()}'))
             # 如果不是常规类型，则需要查看type的具体定义
-            var_type_node  = node.child_by_field_name('type')
-            type_type = var_type_node.type
-            # typedef
-            if type_type == 'type_identifier':
-                type_id = var_type_node.text.decode()
-                type_type = 'type_definition'
-            # struct, enum, union之类的
-            elif type_type in [
-                'struct_specifier',
-                'union_specifier',
-                'enum_specifier',
-            ]:
-                type_id = var_type_node.child_by_field_name('name')
-                if type_id:
-                    type_id = type_id.text.decode()
-                else:
-                    type_id = f"anonymous_{type_type}"
-            else:
+            type_id = self.get_var_type_id(node)
+            if type_id is None:
                 continue
-            global_def_nodes = self.get_struct_def(type_id)
-            if global_def_nodes:
-                res.extend([global_def_node.text.decode()
-                    for global_def_node in global_def_nodes 
-                        if global_def_node])
+            if type_id not in type_defs:
+                global_def_nodes = self.get_struct_def(type_id)
+                type_defs[type_id] = [global_def_node.text.decode()
+                    for global_def_node in global_def_nodes or []
+                        if global_def_node]
+            res.extend(("type", text) for text in type_defs[type_id])
             if res:
                 break
-        if not res:
-            preproc_defs:list[Node] = self.get_preproc_def(identifier)
-            res = [f'{preproc_def.text.decode()}' for preproc_def in preproc_defs]
-        if res:
-            return res
-        return []
+        return res
+
+    # node 中所有变量的声明和定义，identifier -> [完整node]
+    # 与 get_var_init_and_declaration_nodes_from_node 的结果相同，但整个 node 只查询一次
+    def get_var_declarations(self, node:Node) -> dict:
+        declarations = self.var_declarations.get(node.id)
+        if declarations is not None:
+            return declarations
+        declarations = {}
+        for declarator in query_captures("var_declarators", node).get("declarator", []):
+            init_and_declaration_node = declarator.parent
+            for id_node in query_captures("declarator_ids", init_and_declaration_node).get("id", []):
+                declarations.setdefault(id_node.text.decode(), []).append(init_and_declaration_node)
+        self.var_declarations[node.id] = declarations
+        return declarations
+
+    # 批量获取一个函数（或若干行）中每行用到的变量及其定义
+    # func_node 为空时按 lines 中每一行所在的函数查找，都为空时为整个文件
+    # lines 为删除注释后的行号（从1开始），为空时为 func_node 的全部行
+    # 返回 {
+    #     "lines": {行号: [(identifier, definitions 中的下标)]}，与 get_vars_in_line 相同的变量，去掉重复，get_vars_in_line 为 None 的行不记录
+    #     "definitions": [{
+    #         "identifier": 变量名,
+    #         "declaration": [声明或初始化的文本],
+    #         "type": [类型定义的文本],
+    #         "macro": [没有变量声明时的宏定义文本],
+    #         "text": 与 get_local_var_def_new 的结果相同,
+    #     }]
+    # }
+    # 同一个声明（或同名的宏）在多行、多个函数中只解析一次
+    def get_lines_context(self, func_node:Node = None, lines = None) -> dict:
+        if lines is None:
+            scope = func_node or self.root_node
+            lines = range(scope.start_point[0] + 1, scope.end_point[0] + 2)
+        index = self.get_occurrence_index()
+        definition_indexes = {} # (identifier, 声明节点的 id) -> definitions 中的下标
+        resolved = {} # (作用域 node.id, identifier) -> definitions 中的下标
+        type_defs = {}
+        definitions = []
+        res_lines = {}
+        root_declarations = self.get_var_declarations(self.root_node)
+        for new_line_number in lines:
+            target_node = self.get_node_in_line(new_line_number)
+            if not target_node:
+                continue
+            if target_node.type == 'function_definition' and \
+                target_node.end_point[0] + 1 == new_line_number:
+                res_lines[new_line_number] = []
+                continue
+            scope = func_node or self.get_function_include_line_index(new_line_number - 1) or self.root_node
+            declarations = self.get_var_declarations(scope)
+            res = []
+            for identifier in dict.fromkeys(index.names_in_range(
+                    target_node.start_byte, target_node.end_byte, 0, index.var_excluded_parents)):
+                key = (scope.id, identifier)
+                if key not in resolved:
+                    var_init_and_declaration_nodes = declarations.get(identifier) or root_declarations.get(identifier, [])
+                    definition_key = (identifier, tuple(node.id for node in var_init_and_declaration_nodes))
+                    if definition_key not in definition_indexes:
+                        parts = self.get_var_def_parts(var_init_and_declaration_nodes, type_defs)
+                        definition = {
+                            "identifier": identifier,
+                            "declaration": [text for kind, text in parts if kind == "declaration"],
+                            "type": [text for kind, text in parts if kind == "type"],
+                            "macro": [],
+                            "text": [text for _, text in parts],
+                        }
+                        if not parts:
+                            definition["macro"] = [preproc_def.text.decode() for preproc_def in self.get_preproc_def(identifier)]
+                            definition["text"] = definition["macro"]
+                        definition_indexes[definition_key] = len(definitions)
+                        definitions.append(definition)
+                    resolved[key] = definition_indexes[definition_key]
+                res.append((identifier, resolved[key]))
+            res_lines[new_line_number] = res
+        return {"lines": res_lines, "definitions": definitions}
 
     # 通过数据类型名找数据类型定义
     def get_struct_def(self, type_identifier:str) -> list[Node]:
-        query = C_LANGUAGE.query(f"""
-        ( _
-            name: (type_identifier) @type_identifier
-            body: (field_declaration_list)
-            (#eq? @type_identifier "{type_identifier}")
-        )
-        (type_definition
-            type: ( _ )
-            declarator: (type_identifier)@type_identifier
-            (#eq? @type_identifier "{type_identifier}")
-        )
-        """)
-        
         # body: (field_declaration_list)    
         res = []
-        for node in query.captures(self.root_node)["type_identifier"]:
-            temp = node.parent
+        for temp in self.get_symbols()["type"].get(type_identifier, []):
             res.append(temp)
             if temp == "type_definition":
                 type_node = temp.child_by_field_name('type')
@@ -869,75 +2582,110 @@ class Cmodule():
             return res
         # 没有搜到，则跨文件
         if self.is_path:
-            Cross_file_res = self.dosomething_in_headers('get_struct_def', type_identifier)
+            Cross_file_res = self.find_in_symbol_index('get_struct_def', 'type', type_identifier)
+            if Cross_file_res is None:
+                Cross_file_res = self.dosomething_in_headers('get_struct_def', type_identifier)
             if Cross_file_res:
                 return Cross_file_res
         return None
     
     def get_all_struct_nodes(self) -> list[Node]:
-        query = C_LANGUAGE.query(f"""
-        ( _
-            name: (type_identifier) @type_identifier
-            body: (field_declaration_list)
-        )
-        (type_definition
-            type: ( _ )
-            declarator: (type_identifier)@type_identifier
-        )
-        (enum_specifier
-            body: (enumerator_list) @enumerator_list
-        )
-        """)
-        captures = query.captures(self.root_node)
-        res = []
-        for _, nodes in captures.items():
-            if nodes:
-                for node in nodes:
-                    res.append(node.parent)
+        symbols = self.get_symbols()
+        res = [node for nodes in symbols["type"].values() for node in nodes]
+        res.extend(symbols["enum"])
         return res
     
     # 从数据结构找某个field_identifier的类型
+    # 结构体的字段表由 TypeResolver 建立一次并缓存，typedef a b; 的链也会解析下去
     def get_field_type_in_struct(self, struct_type:str, field_identifier):
-        struct_def_node = self.get_struct_def(struct_type)[-1]
-        query = C_LANGUAGE.query(f"""
-        (field_identifier) @field_name
-        (#eq? @field_name "{field_identifier}")
-        """)
-        for node in query.captures(struct_def_node)["field_name"]:
-            if node.text.decode() != field_identifier:
-                continue
-            temp = node
-            while(temp.type != 'field_declaration'): 
-                temp = temp.parent
-            type_node = temp.child_by_field_name('type')
-            return type_node.text.decode()
+        resolver = self.get_type_resolver()
+        fields = resolver.resolve_fields(self, resolver.resolve(self, struct_type), [field_identifier])
+        if fields:
+            return fields[-1].type_text
         return None
 
+    # 可以跨文件时使用项目共享的 TypeResolver，否则使用实例自己的
+    def get_type_resolver(self) -> TypeResolver:
+        if self.is_path and self.project_dir:
+            return get_type_resolver(self.project_dir)
+        if self.type_resolver is None:
+            self.type_resolver = TypeResolver()
+        return self.type_resolver
+
+    # 类型名（可以带 struct、const、* 等修饰）经过 typedef 链解析后的 TypeInfo，找不到时返回 None
+    def resolve_type(self, type_name:str):
+        return self.get_type_resolver().resolve(self, type_name)
+
+    # 解析 a.b->c 这样的成员访问，a 为 func_node 中（找不到时在文件作用域中）声明的变量
+    # 返回每个字段的 FieldInfo（b、c），任何一步找不到时返回 None；. 和 -> 不区分
+    def resolve_member_access(self, expression:str, func_node:Node = None):
+        names = MEMBER_ACCESS_RE.split(expression.strip())
+        declarations = self.get_var_declarations(func_node or self.root_node).get(names[0])
+        if not declarations and func_node is not None:
+            declarations = self.get_var_declarations(self.root_node).get(names[0])
+        if not declarations:
+            return None
+        resolver = self.get_type_resolver()
+        info = resolver.resolve_node(self, declarations[0].child_by_field_name('type'), self.path)
+        return resolver.resolve_fields(self, info, names[1:])
+
+    # 清除注释后代码的行数
+    def get_line_count(self) -> int:
+        if self.line_count is None:
+            self.line_count = self.code_bytes.count(b'\n') + 1 if self.code_bytes else 0
+        return self.line_count
+
     def get_switch_lines(self, new_line_index:int):
         target_line = new_line_index - 1
         root_node = self.root_node
         temp = root_node
         start_line = 0
-        end_line = len(self.code.splitlines()) - 1
+        end_line = self.get_line_count() - 1
         last_switch_node = None
         while temp.start_point[0] <= target_line:
-            found_child = False
-            for node in temp.named_children:
-                start_line = node.start_point[0]
-                end_line = node.end_point[0]
-                if start_line <= target_line <= end_line:
-                    if node.type == 'switch_statement':
-                        last_switch_node = node
-                    temp = node
-                    found_child = True
-                    break
-            if not found_child:
+            node = self.get_child_in_line(temp, target_line)
+            if not node:
+                # 没有子节点包含该行时，结果为最后一个子节点的范围
+                if temp.named_child_count:
+                    last_child = temp.named_child(temp.named_child_count - 1)
+                    start_line = last_child.start_point[0]
+                    end_line = last_child.end_point[0]
                 break
+            start_line = node.start_point[0]
+            end_line = node.end_point[0]
+            if node.type == 'switch_statement':
+                last_switch_node = node
+            temp = node
         if last_switch_node:
             start_line = last_switch_node.start_point[0]
             end_line = last_switch_node.end_point[0]
         return start_line, end_line
 
+# 在子进程中解析头文件，只返回可以 pickle 的符号集合
+def get_header_exports_from_file(path:str, project_dir:str = "") -> dict:
+    return get_cmodule(path, project_dir).get_header_exports()
+
+# 用线程池同时分析多个文件，各线程共享 module_cache、include 图和编译好的 query
+# analysis 为 Cmodule 的方法名或 analysis(module, *args) 形式的函数
+# 返回 {"results": {path: 结果}, "errors": {path: 错误信息}}，结果中可以包含 Node
+# tree-sitter 的解析和查询执行时不释放 GIL，CPU 密集的分析用进程池（如 project_index.index_project）更快
+def analyze_files(paths:list[str], analysis, *args, project_dir:str = "", workers:int = None) -> dict:
+    def run(path):
+        module = get_cmodule(path, project_dir)
+        if isinstance(analysis, str):
+            return getattr(module, analysis)(*args)
+        return analysis(module, *args)
+    results = {}
+    errors = {}
+    with ThreadPoolExecutor(max_workers=workers or min(32, (os.cpu_count() or 1) + 4), thread_name_prefix="cmodule") as executor:
+        futures = {path: executor.submit(run, path) for path in paths}
+        for path, future in futures.items():
+            try:
+                results[path] = future.result()
+            except Exception as e:
+                errors[path] = f"{type(e).__name__}: {e}"
+    return {"results": results, "errors": errors}
+
 if __name__ == '__main__': 
     cm = Cmodule(
         input='/public/github_repos/github_repos_c/dentOS/packages/platforms/accton/x86-64/minipack/onlp/builds/x86_64_accton_minipack/module/src/thermali.c',
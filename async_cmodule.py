@@ -0,0 +1,107 @@
+# Cmodule 的 asyncio 接口
+# 读取文件、解析和跨文件查找都在线程池中执行，不阻塞事件循环
+# 同一个文件（或同一个查找）的并发请求合并为一个正在执行的任务，所有请求者共享结果
+import asyncio, os
+from concurrent.futures import ThreadPoolExecutor
+from tree_sitter import Node
+from Cmodule import Cmodule, get_cmodule, get_include_graph, MAX_DEPTH
+
+# 在线程池中执行：取得 Cmodule 并建立符号表，读取、清除注释和解析都在这里完成，事件循环中不再解析
+# get_cmodule 只创建实例，解析要等到第一次使用语法树时
+def load_module(path:str, project_dir:str) -> Cmodule:
+    module = get_cmodule(path, project_dir)
+    module.get_symbols()
+    return module
+
+# 合并请求时用的 key，Node 用 id 表示
+def request_key(*args) -> tuple:
+    return tuple(arg.id if isinstance(arg, Node) else arg for arg in args)
+
+class AsyncCmoduleService():
+    # executor 为空时使用单线程的线程池：tree-sitter 的解析和查询不释放 GIL，更多线程不会更快，
+    # 解析和查找依次执行，但都在事件循环之外；Cmodule 是线程安全的，也可以传入多线程的 executor
+    def __init__(self, project_dir:str = "", executor = None) -> None:
+        self.project_dir = project_dir
+        self.own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix="cmodule")
+        self.in_flight = {} # key -> asyncio.Future
+
+    # 在线程池中执行 func(*args)，key 相同的并发请求只执行一次
+    async def run(self, key:tuple, func, *args):
+        future = self.in_flight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.executor, func, *args)
+            self.in_flight[key] = future
+            future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        # 某个请求者被取消时不取消共享的任务
+        return await asyncio.shield(future)
+
+    # 已解析并建立了符号表的 Cmodule，复用 module_cache
+    async def get_module(self, path:str) -> Cmodule:
+        path = os.path.abspath(path)
+        return await self.run(("module", path), load_module, path, self.project_dir)
+
+    # 在线程池中调用 Cmodule 的方法
+    async def call(self, path:str, method:str, *args):
+        module = await self.get_module(path)
+        return await self.run(request_key(method, module.path, *args), getattr(module, method), *args)
+
+    # 预先在线程池中解析文件的 include 树并建立符号表，之后的跨文件查找不再等待读取和解析
+    async def prefetch_headers(self, path:str, max_depth:int = MAX_DEPTH) -> list[str]:
+        path = os.path.abspath(path)
+        await self.get_module(path)
+        if not self.project_dir:
+            return []
+        search_order = await self.run(("search_order", path, max_depth),
+            get_include_graph(self.project_dir).get_search_order, path, max_depth)
+        await asyncio.gather(*[self.get_module(header_path) for header_path in search_order])
+        return search_order
+
+    async def find_path_in_project(self, path:str, partial_path:str) -> str:
+        return await self.call(path, "find_path_in_project", partial_path)
+
+    async def get_header_path(self, path:str, header:str) -> str:
+        return await self.call(path, "get_header_path", header)
+
+    async def get_function_node(self, path:str, function_id:str):
+        return await self.call(path, "get_function_node", function_id)
+
+    async def get_function_signature(self, path:str, function_id:str):
+        return await self.call(path, "get_function_signature", function_id)
+
+    async def get_struct_def(self, path:str, type_identifier:str) -> list[Node]:
+        return await self.call(path, "get_struct_def", type_identifier)
+
+    async def get_preproc_def(self, path:str, identifier:str) -> list[Node]:
+        return await self.call(path, "get_preproc_def", identifier)
+
+    async def get_enum_def(self, path:str, identifier:str):
+        return await self.call(path, "get_enum_def", identifier)
+
+    # func_node 可以是函数名
+    async def get_local_var_def_new(self, path:str, func_node, identifier:str):
+        if isinstance(func_node, str):
+            func_node = await self.get_function_node(path, func_node)
+            if func_node is None:
+                module = await self.get_module(path)
+                func_node = module.root_node
+        return await self.call(path, "get_local_var_def_new", func_node, identifier)
+
+    async def get_lines_context(self, path:str, func_node:Node = None, lines = None) -> dict:
+        if lines is not None:
+            lines = tuple(lines)
+        return await self.call(path, "get_lines_context", func_node, lines)
+
+    async def check_header_used(self, path:str, header:str):
+        return await self.call(path, "check_header_used", header)
+
+    def close(self):
+        if self.own_executor:
+            self.executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
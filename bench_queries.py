@@ -0,0 +1,79 @@
+# 对比每次查找都拼接 #eq? 重新编译 query 与使用查询注册表的耗时
+# 用法: python bench_queries.py [文件路径] [重复次数]
+import sys, time
+from Cmodule import C_LANGUAGE, Cmodule, get_query, compiled_queries
+
+SAMPLE_CODE = "\n".join(
+    [f"#define MACRO_{i} {i}" for i in range(200)]
+    + [f"typedef struct s{i} {{ int a; long b; }} s{i}_t;" for i in range(200)]
+    + [f"int func_{i}(int x) {{ s{i}_t v; return x + MACRO_{i}; }}" for i in range(200)]
+)
+
+# 旧写法：identifier 拼进 query 字符串，每次调用都重新编译
+def old_get_preproc_def(cm:Cmodule, identifier:str):
+    query = C_LANGUAGE.query(f"""
+    (preproc_def
+        name: (identifier) @macro_name
+        (#eq? @macro_name "{identifier}")
+    ) @macro_def
+    (preproc_function_def
+        name: (identifier) @macro_name
+        (#eq? @macro_name "{identifier}")
+    ) @macro_def
+    """)
+    return query.captures(cm.root_node).get("macro_def", [])
+
+def old_get_struct_def(cm:Cmodule, type_identifier:str):
+    query = C_LANGUAGE.query(f"""
+    ( _
+        name: (type_identifier) @type_identifier
+        body: (field_declaration_list)
+        (#eq? @type_identifier "{type_identifier}")
+    )
+    (type_definition
+        type: ( _ )
+        declarator: (type_identifier)@type_identifier
+        (#eq? @type_identifier "{type_identifier}")
+    )
+    """)
+    return [node.parent for node in query.captures(cm.root_node).get("type_identifier", [])]
+
+def timeit(func, names, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for name in names:
+            func(name)
+    return (time.perf_counter() - start) / (repeat * len(names))
+
+def main():
+    if len(sys.argv) > 1:
+        cm = Cmodule(sys.argv[1])
+    else:
+        cm = Cmodule(SAMPLE_CODE)
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    macros = list(cm.get_all_preproc_defs().keys())[:50]
+    types = [node.child_by_field_name('declarator').text.decode()
+        for node in cm.get_all_struct_nodes() if node.type == 'type_definition'][:50]
+    # 编译一次注册表中的 query，不计入查找耗时
+    compiled_queries.clear()
+    start = time.perf_counter()
+    get_query("preproc_defs")
+    get_query("type_defs")
+    compile_time = time.perf_counter() - start
+
+    rows = []
+    if macros:
+        rows.append(("get_preproc_def",
+            timeit(lambda name: old_get_preproc_def(cm, name), macros, repeat),
+            timeit(cm.get_preproc_def, macros, repeat)))
+    if types:
+        rows.append(("get_struct_def",
+            timeit(lambda name: old_get_struct_def(cm, name), types, repeat),
+            timeit(cm.get_struct_def, types, repeat)))
+    print(f"注册表 query 一次性编译耗时: {compile_time * 1e3:.3f} ms")
+    print(f"{'method':<20}{'before(us)':>14}{'after(us)':>14}{'speedup':>10}")
+    for name, before, after in rows:
+        print(f"{name:<20}{before * 1e6:>14.1f}{after * 1e6:>14.1f}{before / after:>9.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+# 性能基准：生成可配置规模的 C 项目，测量 Cmodule 主要接口的耗时、吞吐量和峰值内存
+# 生成的项目和查找的符号只由参数和随机种子决定，同样的参数在不同版本之间的结果可以直接比较
+# 用法:
+#   python bench_suite.py --files 20 --include-depth 3 --fan-out 2 --output before.json
+#   python bench_suite.py --files 20 --include-depth 3 --fan-out 2 --compare before.json
+import argparse, json, os, platform, random, shutil, statistics, sys, tempfile, time, tracemalloc
+from importlib import metadata
+import Cmodule as cmodule
+from Cmodule import Cmodule, MAX_DEPTH
+
+# 生成项目：include/lvl{d}/h{d}_{j}.h 共 include_depth 层，每层 headers_per_level 个头文件，
+# 每个头文件包含下一层的 fan_out 个头文件；src/file{i}.c 包含第0层的 fan_out 个头文件
+# 返回每个 .c 文件用到的符号（都能沿 include 树找到），作为查找的输入
+def generate_project(root:str, files:int = 20, include_depth:int = 3, fan_out:int = 2,
+        macros:int = 20, structs:int = 10, functions:int = 10, seed:int = 0) -> dict:
+    rng = random.Random(seed)
+    headers_per_level = max(fan_out, files // 2)
+    os.makedirs(os.path.join(root, "src"), exist_ok=True)
+    header_symbols = {} # (d, j) -> {"macros", "types", "functions"}
+    header_includes = {} # (d, j) -> [(d + 1, k)]
+    for d in range(include_depth):
+        os.makedirs(os.path.join(root, "include", f"lvl{d}"), exist_ok=True)
+        for j in range(headers_per_level):
+            includes = []
+            if d + 1 < include_depth:
+                includes = [(d + 1, (j * fan_out + k) % headers_per_level) for k in range(fan_out)]
+            header_includes[(d, j)] = includes
+            symbols = {
+                "macros": [f"M_{d}_{j}_{i}" for i in range(macros)],
+                "types": [f"S_{d}_{j}_{i}_t" for i in range(structs)],
+                "functions": [f"func_{d}_{j}_{i}" for i in range(functions)],
+            }
+            header_symbols[(d, j)] = symbols
+            lines = [f"#ifndef H_{d}_{j}_H", f"#define H_{d}_{j}_H"]
+            lines += [f"#include <lvl{d1}/h{d1}_{k}.h>" for d1, k in includes]
+            lines.append("/* generated header */")
+            for i, name in enumerate(symbols["macros"]):
+                if i % 3 == 0:
+                    lines.append(f"#define {name}(a, b) \\\n    ((a) * {i} + (b))")
+                else:
+                    lines.append(f"#define {name} {i} // macro {i}")
+            for i, name in enumerate(symbols["types"]):
+                lines.append(f"typedef struct s_{d}_{j}_{i} {{\n    int id;\n    long value;\n    char *name;\n    struct s_{d}_{j}_{i} *next;\n}} {name};")
+            for name in symbols["functions"]:
+                lines.append(f"int {name}(int x, const char *p);")
+            lines.append("#endif")
+            with open(os.path.join(root, "include", f"lvl{d}", f"h{d}_{j}.h"), "w") as f:
+                f.write("\n".join(lines) + "\n")
+    manifest = {}
+    for c in range(files):
+        top = [(0, (c * fan_out + k) % headers_per_level) for k in range(fan_out)]
+        # 在 MAX_DEPTH 之内可以找到的头文件
+        reachable, frontier = [], list(top)
+        for _ in range(MAX_DEPTH):
+            frontier = [h for h in dict.fromkeys(frontier) if h not in reachable]
+            reachable.extend(frontier)
+            frontier = [child for h in frontier for child in header_includes[h]]
+        used_macros, used_types, used_functions = set(), set(), set()
+        lines = ["#include <stdio.h>"] + [f"#include <lvl{d}/h{d}_{j}.h>" for d, j in top]
+        lines.append(f"static int counter_{c} = 0;")
+        local_vars = {}
+        for i in range(functions):
+            func_name = f"file{c}_func{i}"
+            symbols = header_symbols[rng.choice(reachable)]
+            type_name = rng.choice(symbols["types"])
+            macro = rng.choice([name for k, name in enumerate(symbols["macros"]) if k % 3])
+            callee = rng.choice(symbols["functions"])
+            used_macros.add(macro)
+            used_types.add(type_name)
+            used_functions.add(callee)
+            local_vars[func_name] = ["item", "count", "total", "i"]
+            lines += [
+                f"// function {i}",
+                f"int {func_name}(int count, const char *p)",
+                "{",
+                f"    {type_name} item;",
+                f"    int total = {macro};",
+                "    /* loop over",
+                "       the items */",
+                "    for (int i = 0; i < count; i++) {",
+                "        item.value += i;",
+                "        if (item.value > total) {",
+                f"            total = {callee}(i, p);",
+                "        }",
+                "    }",
+                "    switch (count) {",
+                "    case 0:",
+                f"        counter_{c}++;",
+                "        break;",
+                "    default:",
+                "        break;",
+                "    }",
+                "    return total + item.id;",
+                "}",
+            ]
+        # 直接包含的头文件都被用到
+        lines += [f"int file{c}_init(void)", "{", "    int total = 0;"]
+        for h in top:
+            callee = header_symbols[h]["functions"][0]
+            used_functions.add(callee)
+            lines.append(f"    total += {callee}(total, \"init\");")
+        lines += ["    return total;", "}"]
+        path = os.path.join(root, "src", f"file{c}.c")
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        manifest[path] = {
+            "headers": [f"<lvl{d}/h{d}_{j}.h>" for d, j in top],
+            "macros": sorted(used_macros),
+            "types": sorted(used_types),
+            "functions": sorted(used_functions),
+            "local_vars": local_vars,
+        }
+    return manifest
+
+# 清空所有进程级缓存，每个基准都从同样的状态开始
+def reset_caches():
+    cmodule.module_cache.clear()
+    cmodule.project_file_indexes.clear()
+    cmodule.include_graphs.clear()
+    cmodule.compiled_queries.clear()
+    cmodule.identifier_filter.clear()
+    cmodule.type_resolvers.clear()
+
+# Cmodule 的各阶段延迟执行，预先解析好，查找的耗时中不包含当前文件的解析
+def load_modules(manifest:dict, project_dir:str) -> dict:
+    modules = {path: Cmodule(path, project_dir) for path in manifest}
+    for module in modules.values():
+        module.root_node
+    return modules
+
+# 读取、清除注释和解析
+def bench_init(manifest, project_dir):
+    for path in manifest:
+        Cmodule(path, project_dir).root_node
+    return len(manifest)
+
+# 只需要头文件列表时不解析
+def bench_get_all_headers(manifest, project_dir):
+    for path in manifest:
+        Cmodule(path, project_dir).get_all_headers()
+    return len(manifest)
+
+def bench_get_preproc_def(manifest, project_dir, modules):
+    ops = 0
+    for path, used in manifest.items():
+        for name in used["macros"]:
+            modules[path].get_preproc_def(name)
+            ops += 1
+    return ops
+
+def bench_get_struct_def(manifest, project_dir, modules):
+    ops = 0
+    for path, used in manifest.items():
+        for name in used["types"]:
+            modules[path].get_struct_def(name)
+            ops += 1
+    return ops
+
+def bench_get_local_var_def_new(manifest, project_dir, modules):
+    ops = 0
+    for path, used in manifest.items():
+        module = modules[path]
+        for func_name, local_vars in used["local_vars"].items():
+            func_node = module.get_function_node(func_name)
+            for name in local_vars:
+                module.get_local_var_def_new(func_node, name)
+                ops += 1
+    return ops
+
+def bench_check_header_used(manifest, project_dir, modules):
+    ops = 0
+    for path, used in manifest.items():
+        for header in used["headers"]:
+            modules[path].check_header_used(header)
+            ops += 1
+    return ops
+
+def bench_line_lookups(manifest, project_dir, modules):
+    ops = 0
+    for module in modules.values():
+        for line in range(1, module.get_line_count() + 1):
+            module.get_node_in_line(line)
+            module.get_vars_in_line(line)
+            module.get_function_include_line_index(line - 1)
+            ops += 1
+    return ops
+
+# 名字 -> (函数, 是否需要预先解析好的 modules)
+BENCHMARKS = {
+    "init": (bench_init, False),
+    "get_all_headers": (bench_get_all_headers, False),
+    "get_preproc_def": (bench_get_preproc_def, True),
+    "get_struct_def": (bench_get_struct_def, True),
+    "get_local_var_def_new": (bench_get_local_var_def_new, True),
+    "check_header_used": (bench_check_header_used, True),
+    "line_lookups": (bench_line_lookups, True),
+}
+
+def run_once(func, needs_modules, manifest, project_dir):
+    reset_caches()
+    args = [manifest, project_dir]
+    if needs_modules:
+        args.append(load_modules(manifest, project_dir))
+    start = time.perf_counter()
+    ops = func(*args)
+    return ops, time.perf_counter() - start
+
+# 每个基准重复 repeat 次取中位数；峰值内存用 tracemalloc 单独测一次，不影响计时
+def run_benchmarks(manifest:dict, project_dir:str, names:list[str] = None, repeat:int = 3) -> dict:
+    results = {}
+    for name in names or BENCHMARKS:
+        func, needs_modules = BENCHMARKS[name]
+        times = []
+        for _ in range(repeat):
+            ops, elapsed = run_once(func, needs_modules, manifest, project_dir)
+            times.append(elapsed)
+        tracemalloc.start()
+        run_once(func, needs_modules, manifest, project_dir)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        seconds = statistics.median(times)
+        results[name] = {
+            "ops": ops,
+            "seconds": seconds,
+            "min_seconds": min(times),
+            "us_per_op": seconds / ops * 1e6 if ops else 0.0,
+            "ops_per_second": ops / seconds if seconds else 0.0,
+            "peak_mib": peak / (1024 * 1024),
+        }
+    return results
+
+def environment() -> dict:
+    try:
+        tree_sitter_version = metadata.version("tree-sitter")
+    except metadata.PackageNotFoundError:
+        tree_sitter_version = ""
+    return {
+        "python": platform.python_version(),
+        "tree_sitter": tree_sitter_version,
+        "platform": platform.platform(),
+    }
+
+def print_results(results:dict, baseline:dict = None, threshold:float = 0.1):
+    header = f"{'benchmark':<24}{'ops':>8}{'total(s)':>12}{'us/op':>12}{'ops/s':>12}{'peak(MiB)':>12}"
+    if baseline:
+        header += f"{'vs base':>10}"
+    print(header)
+    for name, res in results.items():
+        row = f"{name:<24}{res['ops']:>8}{res['seconds']:>12.4f}{res['us_per_op']:>12.1f}{res['ops_per_second']:>12.0f}{res['peak_mib']:>12.2f}"
+        base = (baseline or {}).get(name)
+        if base and base["seconds"]:
+            ratio = res["seconds"] / base["seconds"]
+            row += f"{ratio:>9.2f}x"
+            if ratio > 1 + threshold:
+                row += "  REGRESSION"
+        print(row)
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Cmodule 性能基准")
+    arg_parser.add_argument("--files", type=int, default=20)
+    arg_parser.add_argument("--include-depth", type=int, default=3)
+    arg_parser.add_argument("--fan-out", type=int, default=2)
+    arg_parser.add_argument("--macros", type=int, default=20)
+    arg_parser.add_argument("--structs", type=int, default=10)
+    arg_parser.add_argument("--functions", type=int, default=10)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--repeat", type=int, default=3)
+    arg_parser.add_argument("--bench", action="append", choices=list(BENCHMARKS), help="只运行指定的基准，可重复")
+    arg_parser.add_argument("--project-dir", default="", help="生成项目的目录，默认为临时目录，运行后删除")
+    arg_parser.add_argument("--output", default="", help="把结果保存为 JSON")
+    arg_parser.add_argument("--compare", default="", help="与之前保存的 JSON 结果比较")
+    arg_parser.add_argument("--threshold", type=float, default=0.1, help="耗时增加超过这个比例时标记为 REGRESSION")
+    args = arg_parser.parse_args()
+    config = {
+        "files": args.files,
+        "include_depth": args.include_depth,
+        "fan_out": args.fan_out,
+        "macros": args.macros,
+        "structs": args.structs,
+        "functions": args.functions,
+        "seed": args.seed,
+        "repeat": args.repeat,
+    }
+    project_dir = os.path.abspath(args.project_dir or tempfile.mkdtemp(prefix="cmodule_bench_"))
+    try:
+        manifest = generate_project(project_dir, **{k: v for k, v in config.items() if k != "repeat"})
+        results = run_benchmarks(manifest, project_dir, args.bench, args.repeat)
+    finally:
+        if not args.project_dir:
+            shutil.rmtree(project_dir, ignore_errors=True)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            saved = json.load(f)
+        if saved.get("config") != config:
+            print(f"注意: 基准参数不同 {saved.get('config')} != {config}", file=sys.stderr)
+        baseline = saved.get("results")
+    print_results(results, baseline, args.threshold)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": config, "environment": environment(), "results": results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
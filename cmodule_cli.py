@@ -0,0 +1,190 @@
+# 命令行批量分析：在多个进程中分析项目中的文件，每个文件的结果作为一行 JSON 写出（JSON Lines）
+# 结果边分析边写出，主进程不保存结果，同时在执行的文件数有上限，大项目上内存也不会增长
+# 用法:
+#   python cmodule_cli.py /path/to/project --analysis symbols --analysis includes --workers 8 --output out.jsonl
+#   python cmodule_cli.py /path/to/project --glob 'src/**/*.c' --timeout 30 --output out.jsonl --resume
+import argparse, contextlib, glob, json, os, signal, sys, time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import Cmodule as cmodule
+from Cmodule import Cmodule, get_project_file_index, resolve_header_path
+
+# 节点最后一行的行号（从0开始）：宏定义等节点的结束位置在下一行的行首，这一行不算在节点内
+def get_end_row(node) -> int:
+    end_row = node.end_point[0]
+    if node.end_point[1] == 0 and end_row > node.start_point[0]:
+        end_row -= 1
+    return end_row
+
+# 符号定义 [[kind, name, 开始行, 结束行]]，行号为原文件中的行号（从1开始）
+def analyze_symbols(cm:Cmodule) -> list:
+    res = []
+    to_old = cm.clear_comments_line_map.new_to_old
+    for kind, named_nodes in cm.get_symbols().items():
+        if not isinstance(named_nodes, dict):
+            continue
+        for name, nodes in named_nodes.items():
+            for node in nodes:
+                res.append([kind, name, to_old[node.start_point[0] + 1], to_old[get_end_row(node) + 1]])
+    return res
+
+# 包含的头文件 [{"header": 写法, "path": 项目中的路径，找不到为 ""}]
+def analyze_includes(cm:Cmodule) -> list:
+    return [{"header": header, "path": resolve_header_path(header, cm.path, cm.project_dir)}
+        for header in cm.get_all_headers()]
+
+# 见 Cmodule.which_headers_are_used
+def analyze_header_usage(cm:Cmodule) -> dict:
+    return cm.which_headers_are_used()
+
+# 见 Cmodule.get_lines_context，行号为清除注释后的行号（从1开始）
+def analyze_line_context(cm:Cmodule) -> dict:
+    return cm.get_lines_context()
+
+# 函数名 -> 函数签名
+def analyze_signatures(cm:Cmodule) -> dict:
+    return {name: cm.get_function_signature(name) for name in cm.get_symbols()["function"]}
+
+ANALYSES = {
+    "symbols": analyze_symbols,
+    "includes": analyze_includes,
+    "header_usage": analyze_header_usage,
+    "line_context": analyze_line_context,
+    "signatures": analyze_signatures,
+}
+
+class FileTimeout(Exception):
+    pass
+
+def raise_timeout(signum, frame):
+    raise FileTimeout()
+
+# 在子进程中执行：分析单个文件，返回一条可以 JSON 序列化的记录
+# timeout 用 SIGALRM 实现，只在类 Unix 系统上有效；tree-sitter 的 C 代码中不会被打断，返回 Python 后才抛出
+def analyze_file(path:str, project_dir:str, analyses:list[str], timeout:float = 0) -> dict:
+    record = {"path": path, "results": {}, "error": "", "seconds": 0.0}
+    start = time.perf_counter()
+    use_alarm = timeout > 0 and hasattr(signal, "setitimer")
+    if use_alarm:
+        signal.signal(signal.SIGALRM, raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        # 不是 .c/.h 文件时 Cmodule 会把参数当作代码；Cmodule 的提示信息不能混进标准输出的结果中
+        if not os.path.isfile(path) or not (path.endswith('.c') or path.endswith('.h')):
+            raise FileNotFoundError(f"不是 .c 或 .h 文件: {path}")
+        with contextlib.redirect_stdout(sys.stderr):
+            cm = Cmodule(path, project_dir)
+            for name in analyses:
+                record["results"][name] = ANALYSES[name](cm)
+    except FileTimeout:
+        record["results"] = {}
+        record["error"] = f"Timeout: 超过 {timeout} 秒"
+    except Exception as e:
+        record["results"] = {}
+        record["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    record["seconds"] = time.perf_counter() - start
+    return record
+
+# 子进程的初始化：限制头文件缓存的大小，长时间运行时内存不会一直增长
+def init_worker(cache_entries:int):
+    cmodule.module_cache.max_entries = cache_entries
+
+# 要分析的文件：files、file_list 和 patterns（相对项目目录，支持 **）的并集，都为空时为项目中全部 .c 和 .h 文件
+def collect_paths(project_dir:str, files:list[str] = None, file_list:str = "", patterns:list[str] = None) -> list[str]:
+    paths = [os.path.abspath(path) for path in files or []]
+    if file_list:
+        with (sys.stdin if file_list == "-" else open(file_list)) as f:
+            paths.extend(os.path.abspath(line.strip()) for line in f if line.strip())
+    for pattern in patterns or []:
+        paths.extend(sorted(os.path.abspath(path)
+            for path in glob.glob(os.path.join(project_dir, pattern), recursive=True) if os.path.isfile(path)))
+    if not files and not file_list and not patterns:
+        paths = list(get_project_file_index(project_dir).source_files)
+    return list(dict.fromkeys(paths))
+
+# 检查点文件中每行是一个已经写出结果的文件路径，失败的文件也算已完成
+def load_checkpoint(checkpoint:str) -> set:
+    if not checkpoint or not os.path.exists(checkpoint):
+        return set()
+    with open(checkpoint) as f:
+        return set(line.rstrip('\n') for line in f if line.strip())
+
+# 依次得到每个文件的记录（完成的顺序），同时在执行的文件最多 workers * 4 个
+def iter_records(paths:list[str], project_dir:str, analyses:list[str], workers:int = 1,
+        timeout:float = 0, cache_entries:int = 128):
+    if workers <= 1:
+        init_worker(cache_entries)
+        for path in paths:
+            yield analyze_file(path, project_dir, analyses, timeout)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(cache_entries,)) as executor:
+        pending = set()
+        paths = iter(paths)
+        while True:
+            for path in paths:
+                pending.add(executor.submit(analyze_file, path, project_dir, analyses, timeout))
+                if len(pending) >= workers * 4:
+                    break
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+# 分析 paths 中不在检查点里的文件，结果写入 output（一行一条记录），每写出一条就记录到检查点
+# 返回 {"files": 本次分析的文件数, "errors": 失败的文件数, "skipped": 因检查点跳过的文件数}
+def run(project_dir:str, paths:list[str], analyses:list[str], output = sys.stdout, checkpoint:str = "",
+        workers:int = 1, timeout:float = 0, cache_entries:int = 128) -> dict:
+    done = load_checkpoint(checkpoint)
+    todo = [path for path in paths if path not in done]
+    stats = {"files": 0, "errors": 0, "skipped": len(paths) - len(todo)}
+    checkpoint_file = open(checkpoint, "a") if checkpoint else None
+    try:
+        for record in iter_records(todo, project_dir, analyses, workers, timeout, cache_entries):
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.flush()
+            if checkpoint_file is not None:
+                checkpoint_file.write(record["path"] + "\n")
+                checkpoint_file.flush()
+            stats["files"] += 1
+            if record["error"]:
+                stats["errors"] += 1
+    finally:
+        if checkpoint_file is not None:
+            checkpoint_file.close()
+    return stats
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Cmodule 批量分析，结果输出为 JSON Lines")
+    arg_parser.add_argument("project_dir")
+    arg_parser.add_argument("files", nargs="*", help="要分析的文件，默认为项目中全部 .c 和 .h 文件")
+    arg_parser.add_argument("--glob", action="append", default=[], help="相对项目目录的 glob，支持 **，可重复")
+    arg_parser.add_argument("--file-list", default="", help="每行一个路径的文件，- 表示标准输入")
+    arg_parser.add_argument("--analysis", action="append", choices=list(ANALYSES), help="要执行的分析，可重复，默认为 symbols 和 includes")
+    arg_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    arg_parser.add_argument("--timeout", type=float, default=0, help="单个文件的超时秒数，0 表示不限")
+    arg_parser.add_argument("--cache-entries", type=int, default=128, help="每个进程缓存的头文件个数")
+    arg_parser.add_argument("--output", default="", help="输出文件，默认为标准输出")
+    arg_parser.add_argument("--checkpoint", default="", help="检查点文件，默认为 输出文件.done")
+    arg_parser.add_argument("--resume", action="store_true", help="跳过检查点中已完成的文件，结果追加到输出文件")
+    args = arg_parser.parse_args()
+    project_dir = os.path.abspath(args.project_dir)
+    paths = collect_paths(project_dir, args.files, args.file_list, args.glob)
+    checkpoint = args.checkpoint or (args.output + ".done" if args.output else "")
+    if not args.resume and checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    output = open(args.output, "a" if args.resume else "w") if args.output else sys.stdout
+    start = time.perf_counter()
+    try:
+        stats = run(project_dir, paths, args.analysis or ["symbols", "includes"], output, checkpoint,
+            args.workers, args.timeout, args.cache_entries)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    print(f"分析 {stats['files']} 个文件，失败 {stats['errors']} 个，跳过 {stats['skipped']} 个，"
+        f"耗时 {time.perf_counter() - start:.2f} 秒", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,519 @@
+# 整个项目的并行索引
+# 每个文件在子进程中解析，只返回可以 pickle 的摘要（符号、头文件、函数调用），不返回 tree-sitter 的 Node
+# 主进程解析头文件路径并把摘要合并成 ProjectIndex
+import os, sys, pickle, hashlib, sqlite3, threading, time, zlib
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from Cmodule import Cmodule, get_project_file_index, resolve_header_path
+
+# 单个文件的摘要，所有行号都是清除注释后的行号（从0开始）
+# {
+#     "path": 文件路径,
+#     "symbols": [(kind, name, start_byte, end_byte, start_line, end_line)], kind 与 Cmodule.get_symbols 的键相同
+#     "headers": [头文件的写法，如 <stdio.h> 或 "platform_lib.h"],
+#     "calls": [(调用所在的函数名，文件作用域为 "", 被调用的函数名, 行号)],
+#     "line_map": 原文件行号与清除注释后行号的对应关系（LineMap），解析失败时为 None,
+#     "error": 解析失败时的错误信息，成功为 "",
+# }
+def summarize_module(cm:Cmodule) -> dict:
+    symbols = cm.get_symbols()
+    summary_symbols = []
+    function_names = {}
+    for kind, named_nodes in symbols.items():
+        if not isinstance(named_nodes, dict):
+            continue
+        for name, nodes in named_nodes.items():
+            for node in nodes:
+                summary_symbols.append((kind, name, node.start_byte, node.end_byte, node.start_point[0], node.end_point[0]))
+                if kind == "function":
+                    function_names[node.id] = name
+    calls = []
+    for node in cm.get_all_call_functions():
+        temp = node.parent
+        while temp and temp.type != 'function_definition':
+            temp = temp.parent
+        caller = function_names.get(temp.id, "") if temp else ""
+        calls.append((caller, node.text.decode(), node.start_point[0]))
+    return {
+        "path": cm.path,
+        "symbols": summary_symbols,
+        "headers": cm.get_all_headers(),
+        "calls": calls,
+        "line_map": cm.clear_comments_line_map,
+        "error": "",
+    }
+
+# 在子进程中执行，不能返回 Node
+# fact_cache_path 不为空时先按文件内容的哈希在 FactCache 中查找，内容相同的文件（不论路径）只解析一次
+def summarize_file(path:str, project_dir:str = "", fact_cache_path:str = "") -> dict:
+    try:
+        if not fact_cache_path:
+            return summarize_module(Cmodule(path, project_dir))
+        cache = get_fact_cache(fact_cache_path)
+        with open(path, 'rb') as f:
+            digest = content_hash(f.read())
+        facts = cache.get(digest)
+        if facts is None:
+            summary = summarize_module(Cmodule(path, project_dir))
+            cache.put(digest, {key: value for key, value in summary.items() if key not in ("path", "error")})
+            return summary
+        return dict(facts, path=path, error="")
+    except Exception as e:
+        return {"path": path, "symbols": [], "headers": [], "calls": [], "line_map": None, "error": f"{type(e).__name__}: {e}"}
+
+# 摘要格式或解析结果变化时增加，旧版本的缓存条目不再命中
+FACT_CACHE_VERSION = 2
+
+def content_hash(data:bytes) -> str:
+    return f"{FACT_CACHE_VERSION}:{hashlib.sha1(data).hexdigest()}"
+
+# 按文件内容的哈希保存摘要（不含路径）的磁盘缓存，多个项目、多个进程可以共用同一个数据库
+# 摘要用 pickle 和 zlib 压缩后保存，总大小超过上限时按最近使用时间淘汰
+# 上限保存在数据库中，max_bytes 为 None 时使用数据库中的值（默认 DEFAULT_MAX_BYTES），子进程打开时不需要再传
+class FactCache():
+    DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+    # 命中时最多每隔这么多秒更新一次最近使用时间，减少写入
+    TOUCH_INTERVAL = 60
+
+    def __init__(self, db_path:str = "", max_bytes:int = None) -> None:
+        if not db_path:
+            cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'cmodule')
+            os.makedirs(cache_dir, exist_ok=True)
+            db_path = os.path.join(cache_dir, 'facts.sqlite')
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # 多个进程同时写入时等待对方的事务结束
+        self.db = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        with self.db:
+            self.db.executescript(f"""
+            CREATE TABLE IF NOT EXISTS facts (
+                hash TEXT PRIMARY KEY, data BLOB, size INTEGER, last_used REAL);
+            CREATE INDEX IF NOT EXISTS facts_last_used ON facts (last_used);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+            INSERT OR IGNORE INTO meta VALUES ('total_bytes', 0);
+            INSERT OR IGNORE INTO meta VALUES ('max_bytes', {self.DEFAULT_MAX_BYTES});
+            """)
+        if max_bytes is not None:
+            self.set_max_bytes(max_bytes)
+
+    def get_meta(self, key:str) -> int:
+        return self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()[0]
+
+    @property
+    def max_bytes(self) -> int:
+        with self.lock:
+            return self.get_meta('max_bytes')
+
+    # 修改上限，超出的部分立即淘汰
+    def set_max_bytes(self, max_bytes:int):
+        with self.lock, self.db:
+            self.db.execute("UPDATE meta SET value = ? WHERE key = 'max_bytes'", (max_bytes,))
+            self.evict()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def get(self, digest:str):
+        with self.lock:
+            row = self.db.execute("SELECT data, last_used FROM facts WHERE hash = ?", (digest,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            now = time.time()
+            if now - row[1] > self.TOUCH_INTERVAL:
+                with self.db:
+                    self.db.execute("UPDATE facts SET last_used = ? WHERE hash = ?", (now, digest))
+            return pickle.loads(zlib.decompress(row[0]))
+
+    def put(self, digest:str, facts:dict):
+        data = zlib.compress(pickle.dumps(facts, protocol=pickle.HIGHEST_PROTOCOL))
+        with self.lock, self.db:
+            # 读取旧条目前就取得写锁：sqlite3 的隐式事务在 INSERT 时才开始，
+            # 否则两个进程同时放入同一个 hash 时都看不到旧条目，total_bytes 会被重复累加
+            self.db.execute("BEGIN IMMEDIATE")
+            old = self.db.execute("SELECT size FROM facts WHERE hash = ?", (digest,)).fetchone()
+            self.db.execute("INSERT OR REPLACE INTO facts VALUES (?, ?, ?, ?)", (digest, data, len(data), time.time()))
+            self.db.execute("UPDATE meta SET value = value + ? WHERE key = 'total_bytes'", (len(data) - (old[0] if old else 0),))
+            self.evict(keep=digest)
+
+    # 在调用方的事务中执行，最久没有使用的先淘汰，keep 为刚放入的条目，不淘汰
+    def evict(self, keep:str = ""):
+        total_bytes = self.get_meta('total_bytes')
+        max_bytes = self.get_meta('max_bytes')
+        while total_bytes > max_bytes:
+            rows = self.db.execute(
+                "SELECT hash, size FROM facts WHERE hash != ? ORDER BY last_used LIMIT 64", (keep,)).fetchall()
+            if not rows:
+                break
+            for digest, size in rows:
+                self.db.execute("DELETE FROM facts WHERE hash = ?", (digest,))
+                total_bytes -= size
+                self.evictions += 1
+                if total_bytes <= max_bytes:
+                    break
+        self.db.execute("UPDATE meta SET value = ? WHERE key = 'total_bytes'", (total_bytes,))
+
+    def clear(self):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM facts")
+            self.db.execute("UPDATE meta SET value = 0 WHERE key = 'total_bytes'")
+
+    def stats(self) -> dict:
+        with self.lock:
+            entries = self.db.execute("SELECT COUNT(*) FROM facts").fetchone()[0]
+            total_bytes = self.get_meta('total_bytes')
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "bytes": total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+# 每个进程中 db_path -> FactCache，子进程第一次使用时打开
+fact_caches = {}
+
+def get_fact_cache(db_path:str = "") -> FactCache:
+    cache = fact_caches.get(db_path)
+    if cache is None:
+        cache = fact_caches[db_path] = FactCache(db_path)
+    return cache
+
+class ProjectIndex():
+    def __init__(self, project_dir:str) -> None:
+        self.project_dir = os.path.abspath(project_dir)
+        self.files = {} # path -> 摘要
+        self.symbols = {} # name -> [(kind, path, start_line, end_line)]
+        self.includes = {} # path -> [头文件路径]，找不到的头文件不记录
+        self.calls = {} # path -> [(caller, callee, line)]
+        self.errors = {} # path -> 错误信息
+
+    def add_summary(self, summary:dict):
+        path = summary["path"]
+        if path in self.files:
+            self.remove_file(path)
+        self.files[path] = summary
+        if summary["error"]:
+            self.errors[path] = summary["error"]
+        for kind, name, _, _, start_line, end_line in summary["symbols"]:
+            self.symbols.setdefault(name, []).append((kind, path, start_line, end_line))
+        header_paths = [resolve_header_path(header, path, self.project_dir) for header in summary["headers"]]
+        self.includes[path] = [header_path for header_path in header_paths if header_path]
+        self.calls[path] = summary["calls"]
+
+    def remove_file(self, path:str):
+        self.files.pop(path, None)
+        self.errors.pop(path, None)
+        self.includes.pop(path, None)
+        self.calls.pop(path, None)
+        for name in list(self.symbols.keys()):
+            entries = [entry for entry in self.symbols[name] if entry[1] != path]
+            if entries:
+                self.symbols[name] = entries
+            else:
+                del self.symbols[name]
+
+    # 符号的全部定义 [(kind, path, start_line, end_line)]，kind 为空时不按种类过滤
+    def lookup(self, name:str, kind:str = "") -> list[tuple]:
+        return [entry for entry in self.symbols.get(name, []) if not kind or entry[0] == kind]
+
+    def save(self, path:str):
+        with open(path, 'wb') as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path:str):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+# 紧凑的符号定义记录，不引用 Node，语法树可以在提取后释放
+# kind、name 为 intern 过的字符串，file_id 为 FactStore.paths 中的下标
+# 字节范围和行号都是清除注释后的代码中的位置（行号从0开始），与摘要一致
+class SymbolFact():
+    __slots__ = ("kind", "name", "file_id", "start_byte", "end_byte", "start_line", "end_line")
+
+    def __init__(self, kind:str, name:str, file_id:int, start_byte:int, end_byte:int, start_line:int, end_line:int) -> None:
+        self.kind = sys.intern(kind)
+        self.name = sys.intern(name)
+        self.file_id = file_id
+        self.start_byte = start_byte
+        self.end_byte = end_byte
+        self.start_line = start_line
+        self.end_line = end_line
+
+    def __getstate__(self):
+        return (self.kind, self.name, self.file_id, self.start_byte, self.end_byte, self.start_line, self.end_line)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __repr__(self) -> str:
+        return f"SymbolFact({self.kind!r}, {self.name!r}, {self.file_id}, {self.start_byte}, {self.end_byte}, {self.start_line}, {self.end_line})"
+
+# 只保存 SymbolFact 的符号表，内存随符号个数增长，与源码大小无关
+# 需要定义的文本时重新读取文件并清除注释（不解析），最近读取的几个文件缓存在 code_cache 中
+class FactStore():
+    def __init__(self, project_dir:str = "", max_cached_files:int = 8) -> None:
+        self.project_dir = os.path.abspath(project_dir) if project_dir else ""
+        self.paths = [] # file_id -> 路径
+        self.file_ids = {} # 路径 -> file_id
+        self.file_stats = [] # file_id -> (mtime_ns, size)，提取时的文件状态，删除的文件为 None
+        self.facts_by_file = [] # file_id -> [SymbolFact]
+        self.facts = {} # name -> [SymbolFact]
+        self.max_cached_files = max_cached_files
+        self.code_cache = OrderedDict() # file_id -> 清除注释后的代码
+
+    def get_file_id(self, path:str) -> int:
+        file_id = self.file_ids.get(path)
+        if file_id is None:
+            file_id = self.file_ids[path] = len(self.paths)
+            self.paths.append(sys.intern(path))
+            self.file_stats.append(None)
+            self.facts_by_file.append([])
+        return file_id
+
+    # 合并 summarize_file 得到的摘要，同一文件的旧记录被替换
+    def add_summary(self, summary:dict):
+        path = summary["path"]
+        file_id = self.get_file_id(path)
+        self.remove_file(path)
+        try:
+            stat = os.stat(path)
+            self.file_stats[file_id] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            self.file_stats[file_id] = None
+        facts = self.facts_by_file[file_id] = []
+        for kind, name, start_byte, end_byte, start_line, end_line in summary["symbols"]:
+            fact = SymbolFact(kind, name, file_id, start_byte, end_byte, start_line, end_line)
+            facts.append(fact)
+            self.facts.setdefault(fact.name, []).append(fact)
+
+    # 从已解析的 Cmodule 提取记录后释放它的语法树和源码
+    def add_module(self, cm:Cmodule):
+        self.add_summary(summarize_module(cm))
+        cm.release_tree()
+
+    def add_file(self, path:str, fact_cache_path:str = ""):
+        summary = summarize_file(path, self.project_dir, fact_cache_path)
+        if not summary["error"]:
+            self.add_summary(summary)
+        return summary["error"]
+
+    def remove_file(self, path:str):
+        file_id = self.file_ids.get(path)
+        if file_id is None:
+            return
+        for fact in self.facts_by_file[file_id]:
+            facts = self.facts[fact.name]
+            facts.remove(fact)
+            if not facts:
+                del self.facts[fact.name]
+        self.facts_by_file[file_id] = []
+        self.file_stats[file_id] = None
+        self.code_cache.pop(file_id, None)
+
+    def lookup(self, name:str, kind:str = "") -> list[SymbolFact]:
+        return [fact for fact in self.facts.get(name, []) if not kind or fact.kind == kind]
+
+    def get_path(self, fact:SymbolFact) -> str:
+        return self.paths[fact.file_id]
+
+    # 定义的文本（清除注释后），文件在提取之后被修改或删除时字节范围已经失效，返回 None
+    def get_text(self, fact:SymbolFact):
+        code = self.code_cache.get(fact.file_id)
+        if code is None:
+            path = self.paths[fact.file_id]
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return None
+            if self.file_stats[fact.file_id] != (stat.st_mtime_ns, stat.st_size):
+                return None
+            code = Cmodule(path, self.project_dir).code_bytes
+            self.code_cache[fact.file_id] = code
+            while len(self.code_cache) > self.max_cached_files:
+                self.code_cache.popitem(last=False)
+        else:
+            self.code_cache.move_to_end(fact.file_id)
+        return code[fact.start_byte:fact.end_byte].decode('utf-8', errors='replace')
+
+    def stats(self) -> dict:
+        return {
+            "files": sum(1 for file_stat in self.file_stats if file_stat is not None),
+            "names": len(self.facts),
+            "facts": sum(len(facts) for facts in self.facts_by_file),
+            "cached_files": len(self.code_cache),
+        }
+
+    # 不保存读取过的代码
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["code_cache"] = OrderedDict()
+        return state
+
+    def save(self, path:str):
+        with open(path, 'wb') as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path:str):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+# 项目的函数调用图，由 ProjectIndex 中每个文件的函数调用摘要一次建立，查询时不再解析
+# 节点为函数，用 (path, name) 表示；项目中找不到定义的被调用函数（如库函数）的 path 为 ""
+# 被调用函数先在调用所在的文件中找定义（static 函数），找不到再用项目中同名的全部定义
+# 文件作用域中的调用（如全局变量的初始化）没有调用者，不记录
+# 正向和反向邻接表都以 CSR 形式保存在 array 中：节点 i 的邻居为 targets[offsets[i]:offsets[i + 1]]
+class CallGraph():
+    def __init__(self, index:ProjectIndex) -> None:
+        self.functions = [] # 节点 id -> (path, name)
+        self.function_ids = {} # (path, name) -> 节点 id
+        self.ids_by_name = {} # name -> [节点 id]
+        sites = []
+        for path, calls in index.calls.items():
+            for caller, callee, line in calls:
+                if not caller:
+                    continue
+                caller_id = self.get_node_id(path, caller)
+                for callee_id in self.resolve_callee(index, path, callee):
+                    sites.append((caller_id, line, callee_id))
+        # 调用位置按调用者分组：函数 i 的调用位置为 site_callees/site_lines[site_offsets[i]:site_offsets[i + 1]]
+        # 行号为清除注释后的行号（从0开始）
+        sites.sort()
+        self.site_offsets = self.build_offsets(caller_id for caller_id, _, _ in sites)
+        self.site_callees = array('i', [callee_id for _, _, callee_id in sites])
+        self.site_lines = array('i', [line for _, line, _ in sites])
+        edges = sorted(set((caller_id, callee_id) for caller_id, _, callee_id in sites))
+        self.forward_offsets = self.build_offsets(caller_id for caller_id, _ in edges)
+        self.forward_targets = array('i', [callee_id for _, callee_id in edges])
+        edges.sort(key=lambda edge: (edge[1], edge[0]))
+        self.reverse_offsets = self.build_offsets(callee_id for _, callee_id in edges)
+        self.reverse_targets = array('i', [caller_id for caller_id, _ in edges])
+
+    def get_node_id(self, path:str, name:str) -> int:
+        key = (path, name)
+        node_id = self.function_ids.get(key)
+        if node_id is None:
+            node_id = self.function_ids[key] = len(self.functions)
+            self.functions.append(key)
+            self.ids_by_name.setdefault(name, []).append(node_id)
+        return node_id
+
+    def resolve_callee(self, index:ProjectIndex, path:str, name:str) -> list[int]:
+        paths = list(dict.fromkeys(entry[1] for entry in index.lookup(name, "function")))
+        if path in paths:
+            paths = [path]
+        if not paths:
+            paths = [""]
+        return [self.get_node_id(definition_path, name) for definition_path in paths]
+
+    # sources 为按节点 id 排好序的起点，返回每个节点的起始下标
+    def build_offsets(self, sources) -> array:
+        offsets = array('i', bytes(4 * (len(self.functions) + 1)))
+        for source in sources:
+            offsets[source + 1] += 1
+        for i in range(len(self.functions)):
+            offsets[i + 1] += offsets[i]
+        return offsets
+
+    # 名字对应的节点 id，path 不为空时只返回该文件中的定义
+    def find(self, name:str, path:str = "") -> list[int]:
+        return [node_id for node_id in self.ids_by_name.get(name, []) if not path or self.functions[node_id][0] == path]
+
+    def neighbors(self, node_id:int, reverse:bool = False):
+        offsets, targets = (self.reverse_offsets, self.reverse_targets) if reverse else (self.forward_offsets, self.forward_targets)
+        return targets[offsets[node_id]:offsets[node_id + 1]]
+
+    # 直接调用 name 的函数 [(path, name)]
+    def callers(self, name:str, path:str = "") -> list[tuple]:
+        return self.collect(self.find(name, path), reverse=True, max_depth=1)
+
+    # name 直接调用的函数 [(path, name)]
+    def callees(self, name:str, path:str = "") -> list[tuple]:
+        return self.collect(self.find(name, path), reverse=False, max_depth=1)
+
+    # 从 name 出发经过调用能到达的全部函数，max_depth 为空时不限层数
+    def reachable(self, name:str, path:str = "", max_depth:int = None) -> list[tuple]:
+        return self.collect(self.find(name, path), reverse=False, max_depth=max_depth)
+
+    # 经过调用能到达 name 的全部函数
+    def reaching(self, name:str, path:str = "", max_depth:int = None) -> list[tuple]:
+        return self.collect(self.find(name, path), reverse=True, max_depth=max_depth)
+
+    # 广度优先搜索，按距离从近到远返回，不包含起点（除非起点在环上被再次到达）
+    def collect(self, start_ids:list[int], reverse:bool, max_depth:int = None) -> list[tuple]:
+        visited = set()
+        result = []
+        queue = deque((node_id, 0) for node_id in start_ids)
+        while queue:
+            node_id, depth = queue.popleft()
+            if max_depth is not None and depth >= max_depth:
+                continue
+            for neighbor in self.neighbors(node_id, reverse):
+                if neighbor not in visited:
+                    visited.add(neighbor)
+                    result.append(self.functions[neighbor])
+                    queue.append((neighbor, depth + 1))
+        return result
+
+    # name 中的全部调用位置 [(被调用函数的 path, 被调用函数名, 行号)]，按行号排序
+    def call_sites(self, name:str, path:str = "") -> list[tuple]:
+        result = []
+        for caller_id in self.find(name, path):
+            start, end = self.site_offsets[caller_id], self.site_offsets[caller_id + 1]
+            for callee_id, line in zip(self.site_callees[start:end], self.site_lines[start:end]):
+                result.append(self.functions[callee_id] + (line,))
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "functions": len(self.functions),
+            "external": sum(1 for path, _ in self.functions if not path),
+            "edges": len(self.forward_targets),
+            "call_sites": len(self.site_lines),
+        }
+
+# 依次得到每个文件的摘要，workers 大于 1 时用进程池并行解析
+# fact_cache_path 不为空时各进程共用该 FactCache，内容相同的文件只解析一次
+def iter_summaries(project_dir:str, paths:list[str] = None, workers:int = None, chunksize:int = 0, fact_cache_path:str = ""):
+    if paths is None:
+        paths = get_project_file_index(project_dir).source_files
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for path in paths:
+            yield summarize_file(path, project_dir, fact_cache_path)
+        return
+    # 每个进程一次拿一批文件，减少进程间通信
+    chunksize = chunksize or max(1, len(paths) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(summarize_file, paths, [project_dir] * len(paths), [fact_cache_path] * len(paths), chunksize=chunksize)
+
+# 用进程池并行索引整个项目，paths 为空时索引项目中的全部 .c 和 .h 文件
+def index_project(project_dir:str, paths:list[str] = None, workers:int = None, chunksize:int = 0, fact_cache_path:str = "") -> ProjectIndex:
+    project_dir = os.path.abspath(project_dir)
+    index = ProjectIndex(project_dir)
+    for summary in iter_summaries(project_dir, paths, workers, chunksize, fact_cache_path):
+        index.add_summary(summary)
+    return index
+
+# 与 index_project 相同，但只保存紧凑的 SymbolFact，子进程中的语法树用完即丢弃，主进程不保留摘要
+def index_project_facts(project_dir:str, paths:list[str] = None, workers:int = None, chunksize:int = 0, fact_cache_path:str = "") -> FactStore:
+    project_dir = os.path.abspath(project_dir)
+    store = FactStore(project_dir)
+    for summary in iter_summaries(project_dir, paths, workers, chunksize, fact_cache_path):
+        if not summary["error"]:
+            store.add_summary(summary)
+    return store
+
+# 索引整个项目并建立函数调用图
+def build_call_graph(project_dir:str, paths:list[str] = None, workers:int = None, fact_cache_path:str = "") -> CallGraph:
+    return CallGraph(index_project(project_dir, paths, workers, fact_cache_path=fact_cache_path))